@@ -0,0 +1,264 @@
+'''Benchmark how the startup of ckis scales with the size of the config.
+
+Generates a module tree with M modules and a config with N chains of M
+links each in a temporary directory, then times the phases ckis goes
+through before the first link fires:
+
+    imports          importing ckis.runner in a fresh interpreter
+    load_config      reading and parsing the config file
+    sanitize_config  sanitizing the parsed config (module metadata included)
+    sanitize_cached  the same through the config cache, once it is warm
+    get_module       importing and validating all modules
+    validate_module  validating the imported modules again
+    chain_init       creating a Chain for every chain of the config
+
+Nothing is installed or run, so this works on any Linux box without boot
+tooling. Results are printed as JSON (or written to --output), so they can
+be compared between releases:
+
+    python bench/startup.py --chains 1 10 100 --links 5 20 -o before.json
+'''
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# run from a source tree without installing ckis; like ckis itself, keep
+# the tree free of __pycache__
+root = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+sys.dont_write_bytecode = True
+
+from ckis import modules
+from ckis.chain import Chain
+from ckis.config import load_config, load_sanitized_config, sanitize_config
+
+
+def make_modules(moddir, count):
+    '''Write count modules that look like the real ones: options, costs,
+    inputs and outputs. Returns their link names.
+    '''
+    links = []
+
+    for i in range(count):
+        path = moddir / "bench" / f"mod{i}.py"
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        path.write_text(
+            f'modname = "bench/mod{i}"\n'
+            f'moddesc = "synthetic module {i}"\n'
+            f'\n'
+            f'modoptions = {{ "Opt{i}": "file" }}\n'
+            f'modcost = {{ "cpus": 1, "memory": "64M" }}\n'
+            f'optconfig = {{ "Opt{i}" }}\n'
+            f'optinputs = {{ "initrd" }}\n'
+            f'outputs = {{ "initrd" }}\n'
+            f'\n'
+            f'def _helper(self):\n'
+            f'    return self.kver\n'
+            f'\n'
+            f'def fire(self):\n'
+            f'    return self.Initrd("initrd-{i}.img")\n'
+        )
+
+        links += [ f"bench/mod{i}" ]
+
+    return links
+
+
+def make_config(path, tmpdir, nchains, links):
+    optfile = tmpdir / "opt.conf"
+    optfile.touch()
+    (tmpdir / "boot").mkdir(exist_ok=True)
+    (tmpdir / "esp").mkdir(exist_ok=True)
+
+    lines = [
+        "[global]",
+        f'boot = "{tmpdir / "boot"}"',
+        f'esp = "{tmpdir / "esp"}"',
+        "",
+    ]
+
+    for c in range(nchains):
+        lines += [
+            "[[chains]]",
+            f'name = "chain{c}"',
+            f"links = {json.dumps(links)}",
+        ]
+        # every chain sets a few options, so there is something to check
+        lines += [ f'Opt{i} = "{optfile}"' for i in range(0, len(links), 3) ]
+        lines += [ "" ]
+
+    path.write_text("\n".join(lines))
+
+
+def reset_modules():
+    modules.module_cache.clear()
+    modules.info_cache.clear()
+    modules.module_index = None
+
+
+def summarize(times):
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "max": max(times),
+    }
+
+
+def measure(func, repeat, setup=None):
+    times = []
+
+    for _ in range(repeat):
+        if setup:
+            setup()
+
+        start = time.perf_counter()
+        func()
+        times += [ time.perf_counter() - start ]
+
+    return summarize(times)
+
+
+def measure_imports(repeat):
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        "import ckis.runner\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    env = os.environ | { "PYTHONPATH": str(root) }
+
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [ sys.executable, "-B", "-c", code ],
+            check=True, capture_output=True, text=True, env=env,
+        ).stdout
+        times += [ float(out) ]
+
+    return summarize(times)
+
+
+def bench_case(nchains, nlinks, repeat):
+    with tempfile.TemporaryDirectory(prefix="ckis-bench-") as tmp:
+        tmpdir = pathlib.Path(tmp)
+        moddir = tmpdir / "modules"
+        conffile = tmpdir / "config.toml"
+
+        links = make_modules(moddir, nlinks)
+        make_config(conffile, tmpdir, nchains, links)
+
+        modules.moddirs = [ str(moddir) ]
+        modules.cachedir = tmpdir / "cache" / "modules"
+
+        data = conffile.read_bytes()
+        config = load_config(str(conffile))
+        vcfg = sanitize_config(config)
+        mods = []
+
+        def get_modules():
+            mods[:] = [ modules.get_module(link) for link in links ]
+
+        def validate_modules():
+            for mod in mods:
+                modules.validate_module(mod)
+
+        def init_chains():
+            for chaincfg in vcfg["chains"]:
+                Chain("0.0.0", chaincfg)
+
+        # warm up the cache once, as the second run of ckis would
+        load_sanitized_config(data, tmpdir / "cache" / "config")
+
+        phases = {
+            "load_config": measure(
+                lambda: load_config(str(conffile)), repeat
+            ),
+            "sanitize_config": measure(
+                lambda: sanitize_config(config), repeat, reset_modules
+            ),
+            "sanitize_cached": measure(
+                lambda: load_sanitized_config(
+                    data, tmpdir / "cache" / "config"
+                ),
+                repeat, reset_modules
+            ),
+            "get_module": measure(get_modules, repeat, reset_modules),
+            "validate_module": measure(validate_modules, repeat),
+            "chain_init": measure(init_chains, repeat),
+        }
+
+    return {
+        "chains": nchains,
+        "links": nlinks,
+        "phases": phases,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = "benchmark the startup of ckis"
+    )
+
+    parser.add_argument(
+        "--chains",
+        type = int,
+        nargs = "+",
+        default = [ 1, 10, 100 ],
+        metavar = "N",
+        help = "numbers of chains to benchmark (default: 1 10 100)"
+    )
+    parser.add_argument(
+        "--links",
+        type = int,
+        nargs = "+",
+        default = [ 5, 20 ],
+        metavar = "M",
+        help = "numbers of links per chain to benchmark (default: 5 20)"
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type = int,
+        default = 5,
+        metavar = "R",
+        help = "how often to run every phase (default: 5)"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type = argparse.FileType("w"),
+        default = sys.stdout,
+        metavar = "file",
+        help = "write the results to file instead of stdout"
+    )
+
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "imports": measure_imports(args.repeat),
+        "cases": [
+            bench_case(nchains, nlinks, args.repeat)
+            for nchains in args.chains
+            for nlinks in args.links
+        ],
+    }
+
+    json.dump(results, args.output, indent=2)
+    args.output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
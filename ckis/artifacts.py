@@ -3,7 +3,7 @@ import pathlib
 from collections import UserList
 
 
-from .util import filter_class, to_path
+from .util import to_path
 
 
 class ArtifactPath:
@@ -13,14 +13,32 @@ class ArtifactPath:
     def __set__(self, obj, value):
         obj._path = to_path(obj._chain.cwd, value)
 
+        # a new path is a file that the link is going to write
+        obj.readonly = False
+
 
 class Artifact:
     path = ArtifactPath()
 
-    def __init__(self, chain, path, installed=False):
+    @property
+    def transfer(self):
+        '''How the file of this artifact was copied to its path, e.g.
+        "reflink", or None if the chain didn't copy it.
+        '''
+        return self._chain._transfers.get(self.path, None)
+
+    # Read-only artifacts refer to a file that is not owned by the chain,
+    # e.g. the kernel in /usr/lib/modules. Links can read them from there,
+    # but have to use Chain.materialize to get a copy they can change.
+    def __init__(self, chain, path, installed=False, readonly=False):
         self._chain = chain
         self.path = path
         self.installed = installed
+        self.readonly = readonly
+
+        # name of the link that produced this artifact; set by the chain
+        # when the artifact is stored
+        self.link = getattr(chain, "link", None)
 
 
 class Config(Artifact):
@@ -32,10 +50,21 @@ class Symbols(Artifact):
 class Initrd(Artifact):
     pass
 
+# a list of kernel modules, one per line in the order they have to be
+# loaded, as paths relative to the module directory root
+class Kmods(Artifact):
+    def __init__(
+        self, chain, path, installed=False, readonly=False, root=None
+    ):
+        super().__init__(chain, path, installed, readonly)
+        self.root = str(root) if root is not None else None
+
 # meta class used by signing tools
 class Signable(Artifact):
-    def __init__(self, chain, path, installed=False, signed=False):
-        super().__init__(chain, path, installed)
+    def __init__(
+        self, chain, path, installed=False, signed=False, readonly=False
+    ):
+        super().__init__(chain, path, installed, readonly)
         self.signed = signed
 
 
@@ -47,14 +76,56 @@ class Uki(Signable):
 
 
 
-## are we gonna use this?
+def artifact_state(art):
+    '''The public attributes of an artifact, apart from its path and the
+    link that produced it, e.g. whether it is signed.
+    '''
+    return {
+        key: val for key, val in vars(art).items()
+        if not key.startswith("_") and key != "link"
+    }
+
+
+def to_artifact_class(kind):
+    if isinstance(kind, type) and issubclass(kind, Artifact):
+        return kind
+    elif isinstance(kind, str):
+        return get_artifact_class(kind)
+    else:
+        raise KeyError(f"Unknown artifact type '{kind}'!")
+
+
+def get_artifact_class(name):
+    '''Get the Artifact subclass for a type name as used by modules in
+    their inputs and outputs, e.g. "kernel" for Kernel.
+    '''
+    cls = globals().get(name.capitalize(), None)
+
+    if isinstance(cls, type) and issubclass(cls, Artifact):
+        return cls
+    else:
+        raise KeyError(f"Unknown artifact type '{name}'!")
+
+
 
 class ArtifactStore(UserList):
+    '''A list of artifacts, indexed by their type (including all types
+    they are a subclass of, e.g. a Kernel is also a Signable), the link
+    that produced them and their path.
+
+    Every artifact that is ever added is also appended to history, which
+    is never reordered or shortened. Long running users can remember its
+    length and only look at what was added since.
+    '''
+
     def __init__(self, iterable=None):
-        if iterable:
-            iterable = map(self._check, iterable)
+        super().__init__()
+
+        self.history = []
+        self._reindex()
 
-        super().__init__(iterable)
+        if iterable:
+            self.extend(iterable)
 
     def _reject(self):
         raise TypeError("Only Artifacts can be stored in ArtifactStore!")
@@ -66,46 +137,173 @@ class ArtifactStore(UserList):
             self._reject()
 
 
-    def __setitem__(self, key, item):
-        self._check(item)
-        self.data[key] = value
+    ######## indexes ########
+
+    def _reindex(self):
+        self._types = {}
+        self._links = {}
+        self._paths = {}
+
+        for item in self.data:
+            self._index(item)
+
+    def _index(self, item):
+        for cls in type(item).__mro__:
+            if not issubclass(cls, Artifact):
+                break
+
+            self._types.setdefault(cls, []).append(item)
+            self._links.setdefault((item.link, cls), []).append(item)
+
+        self._paths.setdefault(item.path, []).append(item)
+
+    def _add(self, item):
+        self._index(item)
+        self.history.append(item)
+
+
+    ######## queries ########
+
+    def latest(self, kind=Artifact, links=None):
+        '''Get the most recently added artifact of type kind, which is an
+        Artifact subclass or its name, or None if there is none. If links
+        is given, only artifacts produced by these links count, and the
+        last link in links that produced one wins.
+        '''
+        kind = to_artifact_class(kind)
+
+        if links is None:
+            l = self._types.get(kind, None)
+            return l[-1] if l else None
+
+        for link in reversed(links):
+            if l := self._links.get((link, kind), None):
+                return l[-1]
+
+        return None
+
 
+    def query(
+        self, kind=Artifact, link=None, path=None, installed=None, signed=None
+    ):
+        '''Get all artifacts of type kind, in the order they were added,
+        that match every other argument that is not None.
+        '''
+        kind = to_artifact_class(kind)
+
+        if path is not None:
+            candidates = self._paths.get(pathlib.Path(path), [])
+        elif link is not None:
+            candidates = self._links.get((link, kind), [])
+        else:
+            candidates = self._types.get(kind, [])
+
+        return [
+            item for item in candidates
+            if isinstance(item, kind)
+            and (link is None or item.link == link)
+            and (path is None or item.path == pathlib.Path(path))
+            and (installed is None or item.installed == installed)
+            and (signed is None or getattr(item, "signed", None) == signed)
+        ]
+
+
+    def since(self, pos):
+        '''Artifacts added after the history had length pos.'''
+        return self.history[pos:]
+
+
+    ######## list interface ########
 
     def __getitem__(self, key):
 
         # convert string keys to their class equivalent
-        if isinstance(key, str):
-            classname = key.capitalize()
-            if classname in globals():
-                return filter_class(self.data, globals()[classname])
-            else:
+        if isinstance(key, str) or isinstance(key, type):
+            try:
+                return list(self._types.get(to_artifact_class(key), []))
+            except KeyError:
                 raise KeyError("Key must be a valid Artifact subclass or int!")
 
-        elif isinstance(key, type) and issubclass(key, Artifact):
-            return filter_class(self.data, key)
-
         else:
             return self.data[key]
 
 
+    def __setitem__(self, key, item):
+        if isinstance(key, slice):
+            item = list(map(self._check, item))
+            self.history.extend(item)
+        else:
+            self._check(item)
+            self.history.append(item)
+
+        self.data[key] = item
+        self._reindex()
+
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self._reindex()
+
+
     def append(self, item):
         self._check(item)
         self.data.append(item)
+        self._add(item)
 
 
     def insert(self, index, item):
         self._check(item)
         self.data.insert(index, item)
+        self.history.append(item)
+        self._reindex()
 
 
     def extend(self, other):
-        list(map(self._check, other))
+        other = list(map(self._check, other))
 
-        self.data.extend(other)
+        for item in other:
+            self.data.append(item)
+            self._add(item)
 
 
     def __iadd__(self, other):
-        # check for invalid types by exhausting the map
-        list(map(self._check, other))
+        self.extend(other)
+
+        return self
+
+
+    def pop(self, i=-1):
+        item = self.data.pop(i)
+        self._reindex()
+
+        return item
+
+
+    def remove(self, item):
+        self.data.remove(item)
+        self._reindex()
+
+
+    def clear(self):
+        self.data.clear()
+        self._reindex()
+
+
+    def reverse(self):
+        self.data.reverse()
+        self._reindex()
+
+
+    def sort(self, *args, **kwargs):
+        self.data.sort(*args, **kwargs)
+        self._reindex()
+
+
+    def fork(self):
+        '''Copy the store, so artifacts can be added to either without
+        affecting the other. The artifacts themselves are shared.
+        '''
+        new = ArtifactStore(self.data)
+        new.history = list(self.history)
 
-        self.data += other
+        return new
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+
+from .util import transfer_file
+
+
+default_cachedir = pathlib.Path("/var/cache/ckis")
+default_cachesize = 1024 * 1024 * 1024 # 1 GiB
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def make_key(*parts):
+    '''Combine parts, which should be json serializable, into a key.'''
+    h = hashlib.sha256()
+    h.update(json.dumps(parts, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
+def dir_size(path):
+    size = 0
+
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+
+    return size
+
+
+class Cache:
+    '''A directory of entries, each a set of files stored under a key.
+    Entries are created atomically, so several processes can use the same
+    cache at once. Every entry has a manifest; its mtime is updated on every
+    use and entries that have not been used for the longest time are
+    evicted first.
+    '''
+
+    def __init__(self, root, maxsize=default_cachesize):
+        self.root = pathlib.Path(root)
+        self.maxsize = maxsize
+
+
+    def writable(self):
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            return False
+
+        return os.access(self.root, os.W_OK)
+
+
+    def _entry(self, key):
+        return self.root / key[:2] / key
+
+
+    def lookup(self, key):
+        '''Return the directory and manifest of the entry for key, or None
+        if there is none.
+        '''
+        entry = self._entry(key)
+
+        try:
+            with open(entry / "manifest.json") as f:
+                manifest = json.load(f)
+
+            # mark as recently used
+            os.utime(entry / "manifest.json")
+        except (OSError, ValueError):
+            return None
+
+        return entry, manifest
+
+
+    def store(self, key, files, manifest):
+        '''Store files, a dict mapping names in the entry to their source
+        paths, together with manifest, under key. Does nothing if the entry
+        already exists.
+        '''
+        entry = self._entry(key)
+
+        if entry.exists():
+            return
+
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pathlib.Path(tempfile.mkdtemp(prefix=".new-", dir=entry.parent))
+
+        try:
+            for name, src in files.items():
+                transfer_file(src, tmp / name)
+
+            with open(tmp / "manifest.json", "w") as f:
+                json.dump(manifest, f)
+
+            tmp.rename(entry)
+        except OSError:
+            # most likely someone else stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+
+
+    def entries(self):
+        '''Yield (last use, size, path) of all entries.'''
+        for manifest in self.root.glob("*/*/manifest.json"):
+            entry = manifest.parent
+
+            try:
+                yield manifest.stat().st_mtime, dir_size(entry), entry
+            except FileNotFoundError:
+                # removed while looking at it
+                continue
+
+
+    def stats(self):
+        entries = list(self.entries())
+
+        return {
+            "entries": len(entries),
+            "size": sum(size for _, size, _ in entries),
+            "maxsize": self.maxsize,
+        }
+
+
+    def prune(self, maxsize=None):
+        '''Evict the least recently used entries until the cache is no
+        larger than maxsize. Returns the number of evicted entries.
+        '''
+        if maxsize is None:
+            maxsize = self.maxsize
+
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+
+        for _, size, entry in entries:
+            if total <= maxsize:
+                break
+
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            evicted += 1
+
+        return evicted
@@ -1,35 +1,97 @@
+import contextlib
 import copy
 import fnmatch
+import locale
 import os
 import pathlib
-import platform
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 
 from . import artifacts
+from .cache import file_digest, make_key
 from .errors import ConfigError, ModuleError
-from .modules import get_module
-from .util import filter_class, to_list, to_path, search_esp_paths
+from .graph import link_deps, remaining_time
+from .history import link_config
+from .metrics import add_usage, new_usage
+from .modules import get_module, get_module_info
+from .proc import RingLog, default_logsize, run_process
+from .trace import span
+from .util import fsync_dir, get_classname, get_osrelease, same_contents, \
+    to_list, to_path, search_esp_paths, transfer_file
 
 
 
 class Chain:
-    def __init__(self, kver, config):
+    def __init__(
+        self, kver, config, cache=None, durability="safe", timeout=None,
+        logsize=default_logsize, verbose=False, jobserver=None, tracer=None,
+        metrics=None, history=None, schedule="order", signer=None,
+        transaction=None,
+    ):
         self.kver = kver
         self._config = config
-
+        self._cache = cache
+        self._durability = durability
+
+        # output of commands run by links is kept in a log per link, of
+        # which the last logsize bytes are kept
+        self._timeout = timeout
+        self._logsize = logsize
+        self._verbose = verbose
+        self._log = RingLog(logsize)
+        self._deadline = None
+
+        # shared by all chains of a run, to limit the commands run at once
+        self._jobserver = jobserver
+
+        # records what the chain spends its time on, if set
+        self._tracer = tracer
+
+        # records the resources used by every link, if set; the commands of
+        # a link add their usage up in _usage
+        self._metrics = metrics
+        self._usage = new_usage()
+        self._from_cache = False
+
+        # durations of earlier runs, to start the links on the longest path
+        # through the chain first if schedule is "critical-path"
+        self._history = history
+        self._schedule = schedule
+
+        # signs images for all chains of the run, if set
+        self._signer = signer
+
+        # if set, installs are staged in it and written at the end of the
+        # run, together with those of all other chains
+        self._transaction = transaction
+
+        # running commands, so they can be cancelled from another thread
+        self._cancel = threading.Event()
+        self._tasks = set()
+        self._tasks_lock = threading.Lock()
+
+        # Links keep track of their own working directory instead of
+        # changing the one of the process, so several can run at once.
         self.cwd = pathlib.Path(os.getcwd())
         self._dirstack = []
+        self.tmpdir = None
+        self.link = None
         
         # convenience properties
         self.name = config["name"]
 
+        # the chains this one runs links for; more than one if it runs the
+        # links they have in common
+        self.members = [ self.name ]
+
         self.boot = config.get("boot", pathlib.Path("/boot"))
 
         if esp := config.get("esp", None):
             self.esp = esp
-        elif esp := search_esp_path():
+        elif esp := search_esp_paths():
             self.esp = esp
         else:
             # esp not specified and couldn't detect it
@@ -37,8 +99,7 @@ class Chain:
             raise ConfigError("Failed to determine location of the esp!")
 
 
-        # only works if /etc/os-release or /usr/lib/os-release is present
-        self.osrelease = platform.freedesktop_os_release()
+        self.osrelease = dict(get_osrelease())
         
 
         # state variables
@@ -47,80 +108,371 @@ class Chain:
 
         self.store = artifacts.ArtifactStore()
 
+        # how files were copied, by destination; shared by all links
+        self._transfers = {}
+
+        # the files staged in the transaction, by destination, which has
+        # the old contents (if any) until the transaction is committed
+        self._staged = {}
 
-        # import modules
+
+        # Only read what the modules declare; they are imported when their
+        # link fires.
         self.links = {}
         for link in self._config["links"]:
-            mod = get_module(link)
+            mod = get_module_info(link)
             
             self.links[link] = mod
 
 
 
-    def run(self, until=""):
+    def run(self, until="", jobs=0, shared=None, cleanup=True):
         '''
         Run all phases of the chain. Until is a glob pattern to be matched
         against the links. After the current link matches the pattern.
         Execution is terminated.
+
+        Links that don't depend on each other are run at the same time, with
+        at most jobs links running at once (0 means no limit).
+
+        shared is a chain that already ran the leading links of this chain,
+        with the same config. Its artifacts are used instead of running
+        those links again. To share a chain this way, run it with
+        cleanup=False and clean it up after all other chains are done.
         '''
 
-        self.prepare()
+        start = time.monotonic()
+        success = False
+
+        try:
+            self._run(until, jobs, shared, cleanup)
+            success = True
+        finally:
+            # a failed chain installs nothing
+            if not success and self._transaction is not None:
+                self._transaction.discard((self.name, self.kver))
+
+            # the links of shared ran for this chain as well
+            self._wall = time.monotonic() - start
+            if shared is not None:
+                self._wall += shared._wall
+
+            if self._metrics is not None:
+                self._metrics.add_chain(self, self._wall, success)
+
+
+    def _run(self, until, jobs, shared, cleanup):
+        with self._span("prepare", "phase"):
+            self.prepare()
+
+        done = set()
+        if shared:
+            self.store = shared.store.fork()
+            self._staged.update(shared._staged)
+            done = set(shared.links)
 
         if until == "prepare":
             return
 
+        links = []
         for link in self.links:
-            self._run_link(link)
+            links += [ link ]
             if fnmatch.fnmatch(link, until):
-                return
+                break
+        else:
+            until = None
+
+        with self._span("links", "phase", links = len(links)):
+            self._run_links(links, jobs, done)
+
+        if until is None and cleanup:
+            with self._span("cleanup", "phase"):
+                self.cleanup()
+
+
+    def _run_links(self, links, jobs=0, done=set()):
+        # links only depend on earlier links, so this is complete for
+        # any leading part of the chain
+        deps = link_deps(self.links)
+
+        pending = [ link for link in links if link not in done ]
+        done = set(done)
+
+        if self._schedule == "critical-path" and self._history:
+            remaining = remaining_time(
+                deps,
+                self._history.durations(self.links, self._config, self.kver)
+            )
+
+            # ready links are started in this order
+            pending.sort(key = lambda link: -remaining[link])
+
+        import concurrent.futures
+
+        running = {}
+        errors = []
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers = jobs or len(pending) or 1
+        ) as pool:
+            while pending or running:
 
-        self.cleanup()
+                # start everything that is ready, in the order of pending;
+                # after a failure, only wait for the links that are still
+                # running
+                for link in list(pending):
+                    if errors:
+                        break
+                    if deps[link] <= done:
+                        pending.remove(link)
+                        ctx = self._link_context(link)
+                        running[pool.submit(ctx._run_link, link)] = ctx
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when = concurrent.futures.FIRST_COMPLETED
+                )
+
+                for fut in finished:
+                    ctx = running.pop(fut)
+                    link = ctx.link
+
+                    if self._verbose:
+                        ctx._print_log()
+
+                    try:
+                        ret = fut.result()
+                    except Exception as e:
+                        # the chain has failed, don't wait for the rest
+                        errors += [ e ]
+                        self.cancel()
+                        continue
+
+                    self._store_outputs(link, ret)
+                    done.add(link)
+
+        if errors:
+            raise errors[0]
 
 
 
     def _fire_link(self, hook, *args, **kwargs):
-        func = getattr(self.links[hook], "fire")
+        with self._span("import", "module"):
+            func = getattr(get_module(hook), "fire")
 
         # Links are imported from modules; they are not methods,
         # so we need to supply the 'self' argument manually.
         # also they don't take other arguments
-        return func(self)
+        with self._span("fire", "module"):
+            return func(self)
 
 
     def _run_link(self, link):
+        '''Fire link, unless its outputs for the same inputs are cached.
+        Links that install outside of their working directory are always
+        fired.
+        '''
+        start = time.monotonic()
+        ret = None
+
+        try:
+            with self._span(link, "link") as args:
+                ret = self._run_link_cached(link)
+                args["outputs"] = len(ret)
+        finally:
+            wall = time.monotonic() - start
+
+            if self._metrics is not None:
+                self._metrics.add_link(self, wall, ret)
+            if self._history is not None:
+                self._history.add_link(self, wall, ret)
+
+        return ret
+
+
+    def _run_link_cached(self, link):
+        key = None
+
+        if self._timeout:
+            self._deadline = time.monotonic() + self._timeout
+
+        mod = self.links[link]
+
+        # links that install have effects besides their outputs; others
+        # may depend on more than can be put into a key
+        if self._cache and getattr(mod, "cacheable", True) \
+                and not getattr(mod, "installs", False):
+            with self._span("cache lookup", "cache") as args:
+                key = self._cache_key(link)
+                ret = self._restore_outputs(key)
+                args["hit"] = ret is not None
+
+            if ret is not None:
+                self._from_cache = True
+                return ret
+
+        ret = to_list(self._fire_link(link))
+
+        if key:
+            with self._span("cache store", "cache"):
+                self._cache_outputs(key, ret)
+
+        return ret
+
+
+    def _link_context(self, link):
+        '''Create the chain as seen by a single link. It shares everything
+        with the chain, except for the state of the link: its working
+        directory, inputs and config. This allows links to run at the same
+        time.
+        '''
+        ctx = copy.copy(self)
+        ctx.link = link
+        ctx._log = RingLog(self._logsize)
+        ctx._dirstack = []
+        ctx._usage = new_usage()
+        ctx._from_cache = False
+        ctx.pushd(link)
 
-        self.pushd(link)
-        self._prepare_inputs(link)
-        self._prepare_config(link)
+        with ctx._span("prepare inputs", "phase"):
+            ctx._prepare_inputs(link)
+            ctx._prepare_config(link)
 
-        ret = self._fire_link(link)
+        return ctx
 
+
+    ################## link result cache ##################
+
+
+    def _cache_key(self, link):
+        mod = self.links[link]
+
+        def value(val):
+            # the contents of files matter, not their names
+            if isinstance(val, pathlib.Path) and val.is_file():
+                return [ str(val), file_digest(val) ]
+            else:
+                return val
+
+        inputs = {
+            name: [
+                get_classname(art),
+                artifacts.artifact_state(art),
+                file_digest(art.path),
+            ]
+            for name, art in self.inputs.items()
+        }
+
+        # modules can add what else their outputs depend on, e.g. files
+        # they read that are not part of their config; only those are
+        # imported before the link fires
+        if mod.defines("cachekey"):
+            extra = get_module(link).cachekey(self)
+        else:
+            extra = None
+
+        return make_key(
+            link,
+            file_digest(mod.__file__),
+            { key: value(val) for key, val in self.config.items() },
+            inputs,
+            self.kver,
+            extra,
+        )
+
+
+    def _cache_outputs(self, key, ret):
+        files = {}
+        manifest = []
+
+        for i, art in enumerate(ret):
+            # only cache what the link created in its working directory
+            if art.installed or not art.path.is_relative_to(self.cwd):
+                return
+            if not art.path.is_file():
+                return
+
+            files[str(i)] = art.path
+            manifest += [{
+                "class": get_classname(art),
+                "path": str(art.path.relative_to(self.cwd)),
+                "state": artifacts.artifact_state(art),
+            }]
+
+        self._cache.store(key, files, manifest)
+
+
+    def _restore_outputs(self, key):
+        if not (hit := self._cache.lookup(key)):
+            return None
+
+        entry, manifest = hit
+        ret = []
+
+        try:
+            for i, desc in enumerate(manifest):
+                path = self.cwd / desc["path"]
+                path.parent.mkdir(parents=True, exist_ok=True)
+
+                # cache entries are never changed, and neither are the
+                # outputs of links
+                self._transfers[path] = transfer_file(
+                    entry / str(i), path, link=True
+                )
+
+                art = getattr(artifacts, desc["class"])(self, path)
+                for attr, val in desc["state"].items():
+                    setattr(art, attr, val)
+
+                ret += [ art ]
+        except (OSError, KeyError, AttributeError):
+            # evicted while restoring, or garbage; just fire the link
+            return None
+
+        return ret
+
+
+    def _store_outputs(self, link, ret):
         # allow links to return a single item if
         # it only produces one artifact
         ret = to_list(ret)
 
-        self.store.extend(ret)
+        for art in ret:
+            art.link = link
 
-        self.config = {}
-        self.inputs = {}
-        self.popd()
+        self.store.extend(ret)
 
         
     def _prepare_inputs(self, link):
         reqs = getattr(self.links[link], "inputs", set())
         wants = getattr(self.links[link], "optinputs", set())
 
+        # Only artifacts of links configured before this one count, even if
+        # a later link finished first. Those have all finished, as they
+        # are dependencies of this link.
+        order = list(self.links)
+        before = order[:order.index(link)]
+
         self.inputs = {}
 
         for art in reqs | wants:
 
-            # look for produced artifacts of the specified class
-            l = self.store[art]
+            # for now, always take the most recent of this type
+            # (the last one of the link that was configured last)
+            latest = self.store.latest(art, links = before)
 
-            if len(l) != 0:
+            # files installed in a transaction are only written at the end
+            # of the run; until then, links read them where they are staged
+            if latest is not None and latest.path in self._staged:
+                staged = self._staged[latest.path]
+                latest = self.copy(latest)
+                latest.path = staged
+                latest.readonly = True
 
-                # for now, always take the most recent of this type
-                self.inputs[art] = l[-1] 
+            if latest is not None:
+                self.inputs[art] = latest
 
             elif art in reqs:
                 raise ModuleError(f"Required artifact {art} not ready!")
@@ -129,15 +481,8 @@ class Chain:
 
    
     def _prepare_config(self, link):
-        reqs = getattr(self.links[link], "config", set())
-        wants = getattr(self.links[link], "optconfig", set())
-
-        self.config = {}
-
         # config should be sanitized, so required keys are all present
-        for key in reqs | wants:
-            if key in self._config:
-                self.config[key] = self._config[key]
+        self.config = link_config(self.links[link], self._config)
             
 
 
@@ -159,8 +504,15 @@ class Chain:
 
 
     def cleanup(self):
+        '''Remove the working directory of the chain. Does nothing if it is
+        already gone, so it can be called however far the chain got.
+        '''
+        if self.tmpdir is None:
+            return
+
         self.popd()
         self.tmpdir.cleanup()
+        self.tmpdir = None
 
 
     ######## artifact classes ##########
@@ -175,6 +527,9 @@ class Chain:
     def Initrd(chain, *args, **kwargs):
         return artifacts.Initrd(chain, *args, **kwargs)
 
+    def Kmods(chain, *args, **kwargs):
+        return artifacts.Kmods(chain, *args, **kwargs)
+
     def Signable(chain, *args, **kwargs):
         return artifacts.Signable(chain, *args, **kwargs)
 
@@ -191,41 +546,126 @@ class Chain:
     def pushd(self, directory):
         self._dirstack.append(self.cwd)
         self.cwd = to_path(self.cwd, directory)
-        os.chdir(self.cwd)
 
 
     def popd(self):
         self.cwd = self._dirstack.pop()
-        os.chdir(self.cwd)
 
 
-    def cp(self, srcp, destp, recursive=False, symlinks=True):
+    def cp(self, srcp, destp, recursive=False, symlinks=True, link=False):
         '''Copy srcp to destp. If either of these is relative, it will be
         seen as relative to the temporary working directory. To copy a
         directory tree, set recursive=True. Symlinks are copied as-is,
         unless symlinks=False, then they are dereferenced.
 
+        Files are copied in the cheapest way the filesystems allow, see
+        util.transfer_file. If neither srcp nor destp will ever be changed,
+        set link=True to allow hardlinking them.
+
         Returns the path of the created path.
         '''
         destp = to_path(self.cwd, destp)
         srcp = to_path(self.cwd, srcp)
 
+        with self._span("cp", "io", src = str(srcp)) as args:
+            ret = self._cp(srcp, destp, recursive, symlinks, link)
+
+            # only look at the result if someone is going to see it
+            if self._tracer and ret.is_file():
+                args["bytes"] = ret.stat().st_size
+                args["method"] = self._transfers.get(ret, None)
+
+        return ret
+
+
+    def _cp(self, srcp, destp, recursive, symlinks, link):
         if recursive and srcp.is_dir():
             if destp.is_dir():
                 destp = destp / srcp.name
-            else:
-                ret = shutil.copytree(
-                    srcp, destp, symlinks=symlinks, dir_exist_ok=True,
-                )
+
+            ret = shutil.copytree(
+                srcp, destp, symlinks=symlinks, dirs_exist_ok=True,
+            )
         elif srcp.is_dir():
             # todo: better error propagation
             raise ModuleError("Not copying directory when recurive is False.")
+        elif not symlinks and srcp.is_symlink():
+            ret = shutil.copy2(srcp, destp, follow_symlinks=False)
         else:
-            ret = shutil.copy2(srcp, destp, follow_symlinks=symlinks)
+            if destp.is_dir():
+                destp = destp / srcp.name
+
+            self._transfers[destp] = transfer_file(srcp, destp, link)
+            ret = destp
 
         return pathlib.Path(ret)
 
 
+    def install(self, srcp, destp):
+        '''Install srcp as destp, which is typically outside of the working
+        directory, e.g. in /boot or the esp. Nothing is written if destp
+        already has the same contents. Otherwise the file is written under
+        a temporary name in the same directory and renamed to destp, so it
+        is never left half-written. How much is synced to disk before and
+        after renaming depends on the durability of the chain.
+
+        If the chain has a transaction, srcp is only staged in it, and
+        written to destp when the transaction is committed at the end of
+        the run.
+
+        Returns the path of the installed file.
+        '''
+        destp = to_path(self.cwd, destp)
+        srcp = to_path(self.cwd, srcp)
+
+        with self._span("install", "io", dest = str(destp)) as args:
+            self._install(srcp, destp)
+
+            if self._tracer:
+                args["bytes"] = srcp.stat().st_size
+                args["method"] = self._transfers[destp]
+
+        return destp
+
+
+    def _install(self, srcp, destp):
+        if same_contents(srcp, destp):
+            self._transfers[destp] = "unchanged"
+            return
+
+        if self._transaction is not None:
+            self._staged[destp] = self._transaction.stage(
+                (self.name, self.kver), srcp, destp
+            )
+            self._transfers[destp] = "staged"
+            return
+
+        safe = self._durability == "safe"
+
+        fd, tmpp = tempfile.mkstemp(
+            prefix = f".{destp.name}.", suffix = ".tmp", dir = destp.parent
+        )
+
+        try:
+            os.close(fd)
+            method = transfer_file(srcp, tmpp)
+
+            if safe:
+                with open(tmpp, "rb+") as dest:
+                    os.fsync(dest.fileno())
+
+            os.rename(tmpp, destp)
+        except BaseException:
+            pathlib.Path(tmpp).unlink(missing_ok=True)
+            raise
+
+        # make the rename itself durable
+        if safe:
+            fsync_dir(destp.parent)
+
+        self._transfers[destp] = method
+
+
     def mkdir(self, path, parents=False):
         return to_path(self.cwd, path).mkdir(
             parents=parents, exist_ok=parents
@@ -234,12 +674,341 @@ class Chain:
     # why bother? by wrapping the functions, modules don't have to import
     # libraries themselves. They use self.do instead of subprocess.run.
 
-    def do(self, *args, **kwargs):
-        return subprocess.run(*args, **kwargs)
+    def do(self, cmd, check=True, timeout=None, capture_output=False,
+           **kwargs):
+        '''Run cmd in the working directory of the link. Its output is
+        written to the log of the link and, if capture_output is set, also
+        returned. The command is killed after timeout seconds, or when the
+        time given to the link runs out.
+
+        If check is set (the default), a ModuleError with the end of the
+        log is raised if the command fails. Returns a
+        subprocess.CompletedProcess.
+
+        Other arguments are those of subprocess.run. input, text,
+        encoding and errors work the same; stdout and stderr always go to
+        the log, so they can only be subprocess.PIPE, which is the same as
+        capture_output.
+        '''
+        # asyncio takes longer to import than all of ckis, and plan and
+        # check never run commands
+        import asyncio
+
+        kwargs.setdefault("cwd", self.cwd)
+        cmd = [ str(arg) for arg in cmd ]
+
+        text = kwargs.pop("text", False)
+        text = kwargs.pop("universal_newlines", False) or text
+        encoding = kwargs.pop("encoding", None)
+        errors = kwargs.pop("errors", None)
+        decode = text or encoding or errors
+        encoding = encoding or locale.getencoding()
+
+        for stream in ("stdout", "stderr"):
+            if stream not in kwargs:
+                continue
+
+            if kwargs.pop(stream) != subprocess.PIPE:
+                raise ModuleError(
+                    f"{self.link}: the {stream} of commands always goes to"
+                    " the log, it can only be captured!"
+                )
+            capture_output = True
+
+        if (data := kwargs.pop("input", None)) is not None:
+            if "stdin" in kwargs:
+                raise ValueError("stdin and input cannot both be given!")
+            if isinstance(data, str):
+                data = data.encode(encoding, errors or "strict")
+
+            # a file can't block the command or us, unlike a pipe
+            stdin = tempfile.TemporaryFile()
+            stdin.write(data)
+            stdin.seek(0)
+            kwargs["stdin"] = stdin
+        else:
+            stdin = contextlib.nullcontext()
+
+        if self._deadline:
+            left = self._deadline - time.monotonic()
+            timeout = left if timeout is None else min(timeout, left)
+
+        if self._jobserver:
+            # waiting for a slot counts against the time of the link
+            slot = self._jobserver.slot(
+                getattr(self.links[self.link], "modcost", {}), self._deadline
+            )
+            run = self._jobserver.wrap(cmd)
+        else:
+            slot = contextlib.nullcontext()
+            run = cmd
+
+        try:
+            with (
+                self._span(os.path.basename(cmd[0]), "do", cmd = cmd) as args,
+                slot,
+                stdin,
+            ):
+                returncode, out, err, usage = self._run_async(run_process(
+                    run, self._log, capture_output, timeout, **kwargs
+                ))
+                add_usage(self._usage, usage)
+
+                args["returncode"] = returncode
+                args["utime"] = usage.ru_utime
+                args["stime"] = usage.ru_stime
+                args["maxrss"] = usage.ru_maxrss
+        except TimeoutError:
+            raise ModuleError(
+                f"{self.link}: '{cmd[0]}' timed out!{self._log_tail()}"
+            )
+        except asyncio.CancelledError:
+            raise ModuleError(f"{self.link}: '{cmd[0]}' was cancelled!")
+        except OSError as e:
+            raise ModuleError(f"{self.link}: cannot run '{cmd[0]}': {e}")
+
+        if check and returncode != 0:
+            raise ModuleError(
+                f"{self.link}: '{cmd[0]}' failed with exit status"
+                f" {returncode}!{self._log_tail()}"
+            )
+
+        if decode and capture_output:
+            out = out.decode(encoding, errors or "strict")
+            err = err.decode(encoding, errors or "strict")
+
+        return subprocess.CompletedProcess(cmd, returncode, out, err)
+
+
+    def sign(self, srcp, destp, tool="sbsign"):
+        '''Sign the EFI image srcp as destp with tool ("sbsign" or
+        "uefisign"), using the sbkey and sbcert of the config of the link.
+        If the run has a signer, it does the signing, so images are signed
+        only once and a limited number at a time across all chains.
+
+        Signed images are cached by the Authenticode digest of srcp and the
+        fingerprint of the certificate, so an image that was signed before
+        is not signed again.
+
+        Returns the path of the signed image.
+        '''
+        from .pe import authenticode_digest
+        from .signer import cert_fingerprint
+
+        destp = to_path(self.cwd, destp)
+        srcp = to_path(self.cwd, srcp)
+        key = None
+
+        if self._cache:
+            try:
+                key = make_key(
+                    "signature", tool, authenticode_digest(srcp),
+                    cert_fingerprint(self.config["sbcert"]),
+                )
+            except ModuleError:
+                # not a PE image or certificate; let the signing tool
+                # complain
+                pass
+
+        if key is None:
+            self._sign(srcp, destp, tool)
+            return destp
+
+        return self.cached_file(
+            destp, key, lambda destp: self._sign(srcp, destp, tool)
+        )
+
+
+    @contextlib.contextmanager
+    def cpu_slot(self, wanted=None):
+        '''Take CPUs from the jobserver for work the link does in threads
+        of its own instead of in commands, e.g. compressing. Waits for one
+        CPU at most until the time of the link runs out, and takes up to
+        wanted if they are free. Yields the number of CPUs taken; the
+        threads should call lower_priority when they start.
+        '''
+        if not self._jobserver:
+            yield wanted or os.process_cpu_count() or 1
+            return
+
+        with contextlib.ExitStack() as stack:
+            try:
+                cpus = stack.enter_context(
+                    self._jobserver.cpu_slot(wanted, self._deadline)
+                )
+            except TimeoutError:
+                raise ModuleError(
+                    f"{self.link}: timed out waiting for CPUs!"
+                )
+
+            yield cpus
+
+
+    def lower_priority(self):
+        '''Give the calling thread the priority of the jobserver.'''
+        if self._jobserver:
+            self._jobserver.lower_priority()
+
 
+    def cached_file(self, destp, key, build):
+        '''Create the file destp by calling build(destp), unless a file
+        built with the same key (from make_key) is in the cache, which is
+        used instead. The key has to cover everything the contents of the
+        file depend on. Returns the path of destp.
+        '''
+        destp = to_path(self.cwd, destp)
+
+        if self._cache:
+            with self._span(
+                "cache lookup", "cache", file = destp.name
+            ) as args:
+                args["hit"] = False
+
+                if hit := self._cache.lookup(key):
+                    entry, _ = hit
+
+                    try:
+                        self._transfers[destp] = transfer_file(
+                            entry / "file", destp, link=True
+                        )
+                        args["hit"] = True
+                    except OSError:
+                        # evicted in the meantime
+                        pass
+
+            if args["hit"]:
+                return destp
+
+        build(destp)
+
+        if self._cache:
+            self._cache.store(key, { "file": destp }, {})
+
+        return destp
+
+
+    def _sign(self, srcp, destp, tool):
+        from .signer import signing_command
+
+        key = self.config["sbkey"]
+        cert = self.config["sbcert"]
+
+        if self._signer is None:
+            self.do(signing_command(tool, key, cert, srcp, destp))
+            return
+
+        with self._span(f"sign ({tool})", "do", src = str(srcp)) as args:
+            try:
+                log, usage = self._signer.sign(
+                    tool, key, cert, srcp, destp,
+                    cost = getattr(self.links[self.link], "modcost", {}),
+                    deadline = self._deadline, cancel = self._cancel,
+                )
+            except TimeoutError:
+                raise ModuleError(
+                    f"{self.link}: signing {srcp.name} timed out!"
+                )
+            except InterruptedError:
+                raise ModuleError(
+                    f"{self.link}: signing {srcp.name} was cancelled!"
+                )
+            except ModuleError as e:
+                raise ModuleError(f"{self.link}: {e}")
+
+            # as if the link had run the command itself
+            self._log.write(log)
+
+            if usage:
+                add_usage(self._usage, usage)
+
+                args["utime"] = usage.ru_utime
+                args["stime"] = usage.ru_stime
+                args["maxrss"] = usage.ru_maxrss
+
+
+    def _run_async(self, coro):
+        '''Run coroutine coro in an event loop of its own, in a way that
+        it can be cancelled by Chain.cancel.
+        '''
+        import asyncio
+
+        async def guarded():
+            task = (asyncio.get_running_loop(), asyncio.current_task())
+
+            with self._tasks_lock:
+                if self._cancel.is_set():
+                    coro.close()
+                    raise asyncio.CancelledError()
+                self._tasks.add(task)
+
+            try:
+                return await coro
+            finally:
+                with self._tasks_lock:
+                    self._tasks.discard(task)
+
+        return asyncio.run(guarded())
+
+
+    def cancel(self):
+        '''Kill all commands run by the links of the chain, and refuse to
+        run any new ones. Can be called from any thread.
+        '''
+        with self._tasks_lock:
+            self._cancel.set()
+
+            for loop, task in self._tasks:
+                loop.call_soon_threadsafe(task.cancel)
+
+
+    def _span(self, name, cat="", **args):
+        '''A span for the trace, on the track of the chain and the thread of
+        the current link.
+        '''
+        return span(
+            self._tracer, f"{self.name} ({self.kver})", self.link or "chain",
+            name, cat, **args
+        )
+
+
+    def _log_tail(self):
+        tail = self._log.tail()
+        return f"\n{tail}" if tail else ""
+
+
+    def _print_log(self):
+        log = self._log.getvalue().decode(errors="replace")
+
+        if log:
+            # a single write, so logs of parallel links don't mix
+            print(
+                f"==> {self.name} ({self.kver}) {self.link}\n{log}",
+                end = "" if log.endswith("\n") else "\n",
+                flush = True,
+            )
+
+
+
+    def materialize(self, art, name=None):
+        '''Get a private copy of artifact art that the link can change. The
+        file is copied into the working directory of the link, as name or
+        under its own name. Returns the new artifact.
+        '''
+        new = self.copy(art)
+        new.path = name or art.path.name
+        self.cp(art.path, new.path)
+
+        return new
 
 
     def copy(self, obj):
-        return copy.copy(obj)
+        obj = copy.copy(obj)
+
+        # relative paths assigned to a copied artifact are relative to the
+        # link copying it, not the one that created the original
+        if isinstance(obj, artifacts.Artifact):
+            obj._chain = self
+
+        return obj
 
 
@@ -1,6 +1,9 @@
 from .errors import ConfigError
-from .modules import get_module
+from .modules import find_module, get_module_index, get_module_info, \
+    write_atomic
 import copy
+import hashlib
+import json
 import os
 import pathlib
 import tomllib
@@ -57,12 +60,20 @@ def sanitize_key_value(config, opt):
                     raise ConfigError(f"Cannot read file '{path}'!")
             elif mand:
                 err_key_mand(key, src)
-        
+
+        case "str":
+            if has_key(config, key, str):
+                return config[key]
+            elif key in config:
+                raise ConfigError(f"Option '{key}' should be a string!")
+            elif mand:
+                err_key_mand(key, src)
+
         case _:
             raise ConfigError(f"Unkown type: '{tp}'!")
 
 
-def load_config(conf_file=None):
+def find_config(conf_file=None):
 
     filen = None
 
@@ -94,14 +105,116 @@ def load_config(conf_file=None):
     if not filen:
         raise ConfigError("No configuration file found!")
 
-            
-    with open(filen, 'rb') as cfg:
+    return filen
+
+
+def load_config(conf_file=None):
+    with open(find_config(conf_file), 'rb') as cfg:
         config = tomllib.load(cfg)
 
 
     return config
 
 
+######## cache of sanitized configs ########
+
+# Sanitizing imports all modules and checks all paths of all chains. The
+# result only changes when the config file, the modules it uses or those
+# paths change, so it is cached with the mtimes of everything involved.
+
+
+def config_deps(vcfg):
+    paths = set()
+
+    for chain in vcfg["chains"]:
+        for link in chain["links"]:
+            paths.add(str(find_module(link)))
+
+        for val in chain.values():
+            if isinstance(val, pathlib.Path):
+                paths.add(str(val))
+
+    # the module directories decide which modules are used
+    deps = dict(get_module_index()["dirs"])
+
+    for path in paths:
+        deps[path] = os.stat(path).st_mtime_ns
+
+    return deps
+
+
+def deps_valid(deps):
+    for path, mtime in deps.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            if mtime is not None:
+                return False
+
+    return True
+
+
+def encode_config(vcfg):
+    return {
+        "chains": [
+            {
+                key: { "path": str(val) }
+                    if isinstance(val, pathlib.Path) else val
+                for key, val in chain.items()
+            }
+            for chain in vcfg["chains"]
+        ]
+    }
+
+
+def decode_config(cfg):
+    return {
+        "chains": [
+            {
+                key: pathlib.Path(val["path"])
+                    if isinstance(val, dict) else val
+                for key, val in chain.items()
+            }
+            for chain in cfg["chains"]
+        ]
+    }
+
+
+def load_sanitized_config(data, cachedir=None):
+    '''Parse and sanitize the config file with contents data. If the
+    same config was sanitized before and nothing it depends on changed, the
+    result is taken from cachedir.
+    '''
+    key = hashlib.sha256(data).hexdigest()
+
+    if cachedir:
+        try:
+            with open(cachedir / "config.json") as f:
+                cached = json.load(f)
+
+            if cached["key"] == key and deps_valid(cached["deps"]):
+                return decode_config(cached["config"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    vcfg = sanitize_config(tomllib.loads(data.decode()))
+
+    if cachedir:
+        cached = {
+            "key": key,
+            "deps": config_deps(vcfg),
+            "config": encode_config(vcfg),
+        }
+
+        try:
+            write_atomic(cachedir / "config.json", json.dumps(cached).encode())
+        except OSError:
+            pass
+
+    return vcfg
+
+
 # make sure settings are valid and parse them
 def sanitize_config(config):
     vcfg = {} # valid config
@@ -172,7 +285,7 @@ def sanitize_chain(chain):
     if has_key(chain, "links", list):
         for link in chain["links"]:
             if isinstance(link, str):
-                mod = get_module(link)
+                mod = get_module_info(link)
 
                 chain_opts += get_mod_opts(mod)
 
@@ -224,7 +337,7 @@ def get_mod_opts(mod):
 # are present.
 def check_required_opts(chain):
     for link in chain["links"]:
-        mod = get_module(link)
+        mod = get_module_info(link)
         if hasattr(mod, "config"):
             for key in mod.config:
                 if not key in chain:
@@ -0,0 +1,330 @@
+import collections
+import concurrent.futures
+import lzma
+import os
+import shlex
+import stat
+import string
+import tempfile
+import zlib
+
+from .errors import ModuleError
+
+
+default_blocksize = 16 * 1024 * 1024 # 16 MiB
+
+# layers are padded to the block size of most filesystems, so they can be
+# cloned into an initrd by reflink
+layer_alignment = 4096
+
+# files are read and compressed in pieces of this size
+chunk_size = 1024 * 1024
+
+
+######## file lists ########
+
+# The file list has the format of usr/gen_init_cpio of the kernel, one
+# entry per line:
+#
+#   file <name> <location> <mode> <uid> <gid>
+#   dir <name> <mode> <uid> <gid>
+#   slink <name> <target> <mode> <uid> <gid>
+#   nod <name> <mode> <uid> <gid> <dev_type> <maj> <min>
+#
+# and two extensions, to add a whole directory tree as it is on disk, and
+# to start a new layer of the initrd:
+#
+#   tree <name> <location>
+#   layer <name> [<compression>]
+#
+# ${kver} is replaced by the kernel version, and # starts a comment.
+
+
+def _lines(text, kver):
+    text = string.Template(text).safe_substitute(kver=kver)
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        if fields := shlex.split(line, comments=True):
+            yield lineno, fields
+
+
+def parse_file_list(text, kver):
+    '''Parse a file list, with tree entries expanded. Yields tuples of
+    (name, mode, uid, gid, location, target, rdev), where location is the
+    file to take the contents of a regular file from, target the target
+    of a symlink and rdev the device number of a device node. Layers are
+    ignored.
+    '''
+    for lineno, fields in _lines(text, kver):
+        if fields[0] != "layer":
+            yield from _parse_entry(lineno, fields)
+
+
+def parse_layers(text, kver):
+    '''Parse a file list into its layers. Returns a list of (name,
+    compression, entries) tuples, where compression is None if the layer
+    line doesn't give one and entries is a list like parse_file_list
+    yields. Entries before the first layer line form a layer "main".
+    '''
+    layers = [ ("main", None, []) ]
+
+    for lineno, fields in _lines(text, kver):
+        match fields:
+            case [ "layer", name ]:
+                layers += [ (name, None, []) ]
+            case [ "layer", name, compression ]:
+                layers += [ (name, compression, []) ]
+            case [ "layer", *_ ]:
+                raise ModuleError(f"Invalid layer on line {lineno}!")
+            case _:
+                layers[-1][2].extend(_parse_entry(lineno, fields))
+
+    return [ layer for layer in layers if layer[2] ]
+
+
+def _parse_entry(lineno, fields):
+    try:
+        match fields:
+            case [ "file", name, location, mode, uid, gid ]:
+                yield (name, stat.S_IFREG | int(mode, 8), int(uid),
+                       int(gid), location, None, 0)
+            case [ "dir", name, mode, uid, gid ]:
+                yield (name, stat.S_IFDIR | int(mode, 8), int(uid),
+                       int(gid), None, None, 0)
+            case [ "slink", name, target, mode, uid, gid ]:
+                yield (name, stat.S_IFLNK | int(mode, 8), int(uid),
+                       int(gid), None, target, 0)
+            case [ "nod", name, mode, uid, gid, kind, major, minor ]:
+                fmt = { "c": stat.S_IFCHR, "b": stat.S_IFBLK }[kind]
+                yield (name, fmt | int(mode, 8), int(uid), int(gid),
+                       None, None, os.makedev(int(major), int(minor)))
+            case [ "tree", name, location ]:
+                yield from walk_tree(name, location)
+            case _:
+                raise ValueError()
+    except (ValueError, KeyError):
+        raise ModuleError(f"Invalid file list entry on line {lineno}!")
+
+
+def walk_tree(name, location):
+    '''Entries for the directory tree at location, as name.'''
+    for root, dirs, files in os.walk(location):
+        dirs.sort()
+        rel = os.path.relpath(root, location)
+        dest = os.path.normpath(os.path.join(name, rel))
+
+        st = os.lstat(root)
+        yield (dest, st.st_mode, 0, 0, None, None, 0)
+
+        # symlinks to directories are listed in dirs, but not walked
+        links = [ d for d in dirs if os.path.islink(os.path.join(root, d)) ]
+
+        for f in sorted(files + links):
+            path = os.path.join(root, f)
+            st = os.lstat(path)
+
+            if stat.S_ISLNK(st.st_mode):
+                yield (os.path.join(dest, f), st.st_mode, 0, 0, None,
+                       os.readlink(path), 0)
+            elif stat.S_ISREG(st.st_mode):
+                yield (os.path.join(dest, f), st.st_mode, 0, 0, path, None, 0)
+
+
+def _stat(path):
+    try:
+        return os.stat(path)
+    except OSError as e:
+        raise ModuleError(f"Cannot read {path}: {e}")
+
+
+def entries_key(entries):
+    '''What the archive of entries depends on, for cache keys. For the
+    contents of files, their size and mtime are used, as reading them all
+    would take about as long as building the archive.
+    '''
+    key = []
+
+    for name, mode, uid, gid, location, target, rdev in entries:
+        st = _stat(location) if location else None
+        key += [[
+            name, mode, uid, gid, target, rdev,
+            (str(location), st.st_size, st.st_mtime_ns) if st else None,
+        ]]
+
+    return key
+
+
+######## compression ########
+
+def _zstd():
+    # in the standard library from Python 3.14 on
+    try:
+        from compression import zstd
+        return zstd.ZstdCompressor()
+    except ImportError:
+        pass
+
+    try:
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    except ImportError:
+        raise ModuleError("zstd compression needs Python 3.14 or zstandard!")
+
+
+class _Store:
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+# The kernel unpacks concatenated compressed archives, so every block can
+# be compressed on its own. It only checks xz streams with CRC32.
+compressors = {
+    "none": _Store,
+    "gzip": lambda: zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    "xz": lambda: lzma.LZMACompressor(
+        lzma.FORMAT_XZ, check=lzma.CHECK_CRC32
+    ),
+    "zstd": _zstd,
+}
+
+
+######## archives ########
+
+def _pad(n):
+    return b"\0" * (-n % 4)
+
+
+def cpio_header(ino, mode, uid, gid, size, rdev, name):
+    name = name.encode() + b"\0"
+
+    header = b"070701" + b"".join(
+        b"%08X" % val for val in (
+            ino, mode, uid, gid,
+            2 if stat.S_ISDIR(mode) else 1, # nlink
+            0, # mtime; always 0, so the same files give the same initrd
+            size,
+            0, 0, # devmajor, devminor
+            os.major(rdev), os.minor(rdev),
+            len(name),
+            0, # check
+        )
+    )
+
+    return header + name + _pad(len(header) + len(name))
+
+
+def write_block(entries, compression, spool):
+    '''Write entries, a list of (ino, entry) tuples, as a complete cpio
+    archive compressed on its own. Returns a file containing it, which is
+    kept in memory up to spool bytes.
+    '''
+    out = tempfile.SpooledTemporaryFile(max_size=spool)
+    comp = compressors[compression]()
+
+    for ino, (name, mode, uid, gid, location, target, rdev) in entries:
+        name = name.lstrip("/") or "."
+
+        if stat.S_ISLNK(mode):
+            data = target.encode()
+            out.write(comp.compress(
+                cpio_header(ino, mode, uid, gid, len(data), rdev, name)
+                + data + _pad(len(data))
+            ))
+
+        elif stat.S_ISREG(mode):
+            with open(location, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                out.write(comp.compress(
+                    cpio_header(ino, mode, uid, gid, size, rdev, name)
+                ))
+
+                left = size
+                while left > 0:
+                    chunk = f.read(min(chunk_size, left))
+                    if not chunk:
+                        raise ModuleError(f"{location} shrank while reading!")
+                    out.write(comp.compress(chunk))
+                    left -= len(chunk)
+
+            out.write(comp.compress(_pad(size)))
+
+        else:
+            out.write(comp.compress(
+                cpio_header(ino, mode, uid, gid, 0, rdev, name)
+            ))
+
+    out.write(comp.compress(cpio_header(0, 0, 0, 0, 0, 0, "TRAILER!!!")))
+    out.write(comp.flush())
+    out.seek(0)
+
+    return out
+
+
+def write_initrd(entries, outp, compression="gzip", blocksize=None,
+                 workers=None, alignment=None, initializer=None):
+    '''Write entries, as returned by parse_file_list, as an initrd to outp.
+    The entries are split into blocks of about blocksize bytes, which are
+    compressed on their own by up to workers threads (all cores by
+    default), which call initializer when they start. Only a few blocks
+    are in flight at any time, so memory use doesn't depend on the number
+    or size of the files. If alignment is given, the initrd is padded with
+    zeros to a multiple of it, which the kernel skips.
+
+    Returns the number of blocks.
+    '''
+    if compression not in compressors:
+        raise ModuleError(f"Unknown initrd compression '{compression}'!")
+
+    blocksize = blocksize or default_blocksize
+    workers = workers or os.process_cpu_count() or 1
+
+    # compression releases the GIL, so threads use all cores
+    with (
+        concurrent.futures.ThreadPoolExecutor(
+            workers, initializer = initializer
+        ) as pool,
+        open(outp, "wb") as out,
+    ):
+        pending = collections.deque()
+        nblocks = 0
+
+        def flush(limit):
+            while len(pending) > limit:
+                with pending.popleft().result() as block:
+                    while chunk := block.read(chunk_size):
+                        out.write(chunk)
+
+        def submit(block):
+            pending.append(
+                pool.submit(write_block, block, compression, blocksize)
+            )
+            flush(2 * workers)
+
+        block = []
+        size = 0
+
+        # inode numbers only need to be unique within the initrd
+        for ino, entry in enumerate(entries, 1):
+            block += [ (ino, entry) ]
+            size += 110 + len(entry[0])
+            if entry[4]:
+                size += _stat(entry[4]).st_size
+
+            if size >= blocksize:
+                submit(block)
+                nblocks += 1
+                block, size = [], 0
+
+        if block or not nblocks:
+            submit(block)
+            nblocks += 1
+
+        flush(0)
+
+        if alignment:
+            out.write(bytes(-out.tell() % alignment))
+
+    return nblocks
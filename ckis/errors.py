@@ -3,3 +3,6 @@ class ConfigError(Exception):
 
 class ModuleError(Exception):
     pass
+
+class InstallError(Exception):
+    pass
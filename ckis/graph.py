@@ -0,0 +1,93 @@
+from .artifacts import get_artifact_class
+
+
+def consumes(mod):
+    return getattr(mod, "inputs", set()) | getattr(mod, "optinputs", set())
+
+
+def may_provide(output, wanted):
+    '''Whether an artifact declared as output can satisfy an input of type
+    wanted. Either can be the more specific type: a link producing a
+    "signable" might produce a "kernel", and a "kernel" is a "signable".
+    '''
+    out = get_artifact_class(output)
+    want = get_artifact_class(wanted)
+
+    return issubclass(out, want) or issubclass(want, out)
+
+
+def link_deps(links):
+    '''Build the dependency graph of the links of a chain. links maps link
+    names to their modules, in the order they are configured. Returns a
+    dict mapping every link to the set of earlier links it has to wait for.
+
+    A link depends on every earlier link that may produce one of its
+    (optional) inputs. As inputs are always the most recent artifact of
+    their type, all of those links need to have finished. Links that don't
+    declare their outputs could produce anything, so they are run strictly
+    in order with respect to all other links.
+    '''
+    deps = {}
+    earlier = []
+
+    for link, mod in links.items():
+        deps[link] = set()
+        wants = consumes(mod)
+
+        for prev, prevmod in earlier:
+            if (not hasattr(mod, "outputs")
+                or not hasattr(prevmod, "outputs")
+                or any(
+                    may_provide(out, want)
+                    for out in prevmod.outputs for want in wants
+                )
+            ):
+                deps[link].add(prev)
+
+        earlier += [ (link, mod) ]
+
+    return deps
+
+
+def critical_path(deps, durations):
+    '''The longest path through the dependency graph deps, as returned by
+    link_deps, if every link takes as long as durations says. Returns its
+    length and the links on it, in order.
+    '''
+    finish = {}
+    via = {}
+
+    # deps only point to earlier links
+    for link in deps:
+        prev = max(deps[link], key=lambda d: finish[d], default=None)
+        via[link] = prev
+        finish[link] = durations.get(link, 0) + finish.get(prev, 0)
+
+    if not finish:
+        return 0, []
+
+    link = max(finish, key=lambda l: finish[l])
+    length = finish[link]
+
+    path = []
+    while link is not None:
+        path.insert(0, link)
+        link = via[link]
+
+    return length, path
+
+
+def remaining_time(deps, durations):
+    '''For every link, how long it takes at least to finish the chain once
+    it is started: its own duration plus the longest path of links that
+    wait for it.
+    '''
+    remaining = {}
+
+    for link in reversed(list(deps)):
+        after = [
+            remaining[later] for later in remaining if link in deps[later]
+        ]
+        remaining[link] = durations.get(link, 0) + max(after, default=0)
+
+    return remaining
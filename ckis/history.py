@@ -0,0 +1,187 @@
+import threading
+import time
+
+from .cache import make_key
+
+
+# runs kept per module, config and kernel version
+history_keep = 20
+
+schema = '''
+CREATE TABLE IF NOT EXISTS links (
+    module      TEXT NOT NULL,
+    config      TEXT NOT NULL,
+    kver        TEXT NOT NULL,
+    duration    REAL NOT NULL,
+    size        INTEGER NOT NULL,
+    time        REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS links_key ON links (module, config, kver, time);
+'''
+
+
+def link_config(mod, chaincfg):
+    '''The settings of chain config chaincfg that a link of module mod
+    gets to see.
+    '''
+    keys = getattr(mod, "config", set()) | getattr(mod, "optconfig", set())
+
+    return { key: chaincfg[key] for key in keys if key in chaincfg }
+
+
+def config_digest(link, config):
+    return make_key(link, { key: str(val) for key, val in config.items() })
+
+
+class History:
+    '''How long links took and how large their outputs were in earlier
+    runs, in a SQLite database. Only links that were fired are recorded;
+    restoring them from the cache says nothing about how long they take.
+
+    Like a Tracer, a History can be passed to worker processes. They
+    read estimates from the database themselves, but send what they
+    recorded back, so only the parent writes to it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.records = []
+        self._db = None
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        return { "path": self.path }
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+
+    def _connect(self):
+        import sqlite3
+
+        # used by the threads of all chains of the process
+        if not self._db:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript(schema)
+
+        return self._db
+
+
+    def writable(self):
+        import sqlite3
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self._lock:
+                self._connect()
+        except (OSError, sqlite3.Error):
+            return False
+
+        return True
+
+
+    def add_link(self, chain, wall, ret):
+        if ret is None or chain._from_cache:
+            return
+
+        size = sum(
+            art.path.stat().st_size for art in ret
+            if not (art.installed or art.readonly) and art.path.is_file()
+        )
+
+        with self._lock:
+            self.records += [(
+                chain.link,
+                config_digest(chain.link, chain.config),
+                chain.kver,
+                wall,
+                size,
+                time.time(),
+            )]
+
+
+    def collected(self):
+        with self._lock:
+            return list(self.records)
+
+
+    def merge(self, records):
+        with self._lock:
+            self.records += records
+
+
+    def save(self):
+        '''Write what was recorded to the database, and forget the oldest
+        runs of every link that was recorded.
+        '''
+        with self._lock:
+            db = self._connect()
+
+            with db:
+                db.executemany(
+                    "INSERT INTO links VALUES (?, ?, ?, ?, ?, ?)",
+                    self.records
+                )
+
+                for key in { rec[:3] for rec in self.records }:
+                    db.execute(
+                        '''DELETE FROM links WHERE rowid IN (
+                            SELECT rowid FROM links
+                            WHERE module = ? AND config = ? AND kver = ?
+                            ORDER BY time DESC LIMIT -1 OFFSET ?
+                        )''',
+                        key + (history_keep,)
+                    )
+
+            self.records = []
+
+
+    def estimate(self, link, config, kver):
+        '''The expected duration and output size of link with settings
+        config for kernel version kver, as a tuple, or None if it never
+        ran. Other kernel versions are used if there is nothing for kver,
+        as the module and config matter most.
+        '''
+        import statistics
+
+        digest = config_digest(link, config)
+
+        queries = [
+            ("module = ? AND config = ? AND kver = ?", (link, digest, kver)),
+            ("module = ? AND config = ?", (link, digest)),
+            ("module = ?", (link,)),
+        ]
+
+        with self._lock:
+            db = self._connect()
+
+            for where, params in queries:
+                rows = db.execute(
+                    f'''SELECT duration, size FROM links WHERE {where}
+                        ORDER BY time DESC LIMIT ?''',
+                    params + (history_keep,)
+                ).fetchall()
+
+                if rows:
+                    return (
+                        statistics.median(row[0] for row in rows),
+                        int(statistics.median(row[1] for row in rows)),
+                    )
+
+        return None
+
+
+    def durations(self, links, chaincfg, kver):
+        '''The expected durations of links, which map link names to their
+        modules, in chain config chaincfg. Links that never ran are left
+        out.
+        '''
+        durations = {}
+
+        for link, mod in links.items():
+            est = self.estimate(link, link_config(mod, chaincfg), kver)
+            if est:
+                durations[link] = est[0]
+
+        return durations
@@ -0,0 +1,414 @@
+import sys
+import traceback
+
+from .chain import Chain
+from .errors import ConfigError, ModuleError
+from .graph import critical_path, link_deps
+from .modules import get_module_info
+from .util import get_osrelease, search_esp_paths
+
+
+class Job:
+    '''A single chain to be run for a single kernel version.'''
+
+    def __init__(self, kver, chaincfg):
+        self.kver = kver
+        self.config = chaincfg
+        self.name = chaincfg["name"]
+
+    def __str__(self):
+        return f"{self.name} ({self.kver})"
+
+
+class PrefixNode:
+    '''A node of a prefix tree of the chains of jobs for the same kernel
+    version: the links from the root to here, which are run only once for
+    all jobs below, and the nodes of the links that follow, by their key
+    (see link_key). The chains of jobs in ends continue on their own from
+    here.
+    '''
+
+    def __init__(self, links=[]):
+        self.links = links
+        self.jobs = []
+        self.children = {}
+        self.ends = []
+
+
+class Step:
+    '''What a group runs: either job, or, if that is None, the shared
+    links of node. Steps run after their parent, and continue from its
+    chain.
+    '''
+
+    def __init__(self, job=None, node=None, parent=None):
+        self.job = job
+        self.node = node
+        self.parent = parent
+        self.chain = None
+        self.done = False
+        self.error = None
+
+    @property
+    def jobs(self):
+        return [ self.job ] if self.job else self.node.jobs
+
+    def run(self, until="", link_jobs=0, chainopts={}):
+        shared = self.parent.chain if self.parent else None
+
+        if self.job:
+            return run_job(self.job, until, link_jobs, chainopts, shared)
+
+        first = self.node.jobs[0]
+        cfg = first.config | {
+            "name": "+".join(job.name for job in self.node.jobs),
+            "links": self.node.links,
+        }
+        self.chain = Chain(first.kver, cfg, **chainopts)
+        self.chain.members = [ job.name for job in self.node.jobs ]
+        self.chain.run(jobs = link_jobs, shared = shared, cleanup = False)
+
+
+class JobGroup:
+    '''Jobs for the same kernel version whose chains start with the same
+    link, with the same config, together with the prefix tree of their
+    chains. Every part of the chains that several jobs have in common is
+    run only once, and each job continues from where its chain leaves the
+    others.
+    '''
+
+    def __init__(self, jobs, tree=None):
+        self.jobs = jobs
+        self.tree = tree
+
+    def __str__(self):
+        return ", ".join(map(str, self.jobs))
+
+
+    def steps(self):
+        '''The steps to run the jobs, every parent before its children,
+        in the order of jobs otherwise.
+        '''
+        if not self.tree:
+            return [ Step(job) for job in self.jobs ]
+
+        order = { id(job): i for i, job in enumerate(self.jobs) }
+        steps = []
+
+        def visit(node, parent):
+            # nothing to share until the chains part
+            while len(node.children) == 1 and not node.ends:
+                node = next(iter(node.children.values()))
+
+            if len(node.jobs) == 1:
+                steps.append(Step(node.jobs[0], parent = parent))
+                return
+
+            if node.links:
+                parent = Step(node = node, parent = parent)
+                steps.append(parent)
+
+            branches = list(node.children.values()) + node.ends
+            branches.sort(key = lambda branch: min(
+                order[id(job)] for job in (
+                    branch.jobs if isinstance(branch, PrefixNode)
+                    else [ branch ]
+                )
+            ))
+
+            for branch in branches:
+                if isinstance(branch, PrefixNode):
+                    visit(branch, parent)
+                else:
+                    steps.append(Step(branch, parent = parent))
+
+        visit(self.tree, None)
+
+        return steps
+
+
+    def shared(self):
+        '''The links that are run once for several jobs, as a list of
+        (jobs, links) tuples.
+        '''
+        return [
+            (step.node.jobs, step.node.links)
+            for step in self.steps() if not step.job
+        ]
+
+
+def link_key(link, chaincfg):
+    '''What determines the result of a link in a chain: the module and the
+    settings it can see.
+    '''
+    mod = get_module_info(link)
+
+    # links that install get to see the name of the chain and use it; their
+    # results are never the same for different chains
+    if getattr(mod, "installs", False):
+        return None
+
+    keys = getattr(mod, "config", set()) | getattr(mod, "optconfig", set())
+
+    return (
+        link,
+        chaincfg.get("boot", None),
+        chaincfg.get("esp", None),
+        tuple(sorted(
+            (key, str(chaincfg[key])) for key in keys if key in chaincfg
+        )),
+    )
+
+
+def prefix_tree(jobs):
+    '''The prefix tree of the chains of jobs, which must all be for the
+    same kernel version. A chain leaves the tree at its first link without
+    a key.
+    '''
+    root = PrefixNode()
+
+    for job in jobs:
+        node = root
+        node.jobs.append(job)
+
+        for link in job.config["links"]:
+            if (key := link_key(link, job.config)) is None:
+                break
+
+            if key not in node.children:
+                node.children[key] = PrefixNode(node.links + [ link ])
+
+            node = node.children[key]
+            node.jobs.append(job)
+
+        node.ends.append(job)
+
+    return root
+
+
+def group_jobs(jobs):
+    '''Group the jobs by kernel version and the key of their first link;
+    nothing can be shared between groups.
+    '''
+    kvers = {}
+    for job in jobs:
+        kvers.setdefault(job.kver, []).append(job)
+
+    groups = []
+
+    for kjobs in kvers.values():
+        root = prefix_tree(kjobs)
+
+        groups += [
+            JobGroup(list(node.jobs), node) for node in root.children.values()
+        ]
+        groups += [ JobGroup([ job ]) for job in root.ends ]
+
+    return groups
+
+
+def plan_job(job, history=None):
+    '''What running job is expected to look like, from the durations of
+    earlier runs in history. Returns the dependencies of its links, their
+    expected durations (leaving out links that never ran), and the length
+    and links of the critical path of its chain.
+    '''
+    links = { link: get_module_info(link) for link in job.config["links"] }
+    deps = link_deps(links)
+
+    if history:
+        durations = history.durations(links, job.config, job.kver)
+    else:
+        durations = {}
+
+    length, path = critical_path(deps, durations)
+
+    return deps, durations, length, path
+
+
+def schedule_groups(groups, history):
+    '''Sort the groups, and the jobs within them, by the expected length
+    of their critical path, longest first. Starting those first gets a run
+    of several jobs closest to the time its longest job needs.
+    '''
+    lengths = { id(job): plan_job(job, history)[2]
+                for group in groups for job in group.jobs }
+
+    for group in groups:
+        group.jobs.sort(key = lambda job: -lengths[id(job)])
+
+    return sorted(
+        groups, key = lambda group: -max(lengths[id(j)] for j in group.jobs)
+    )
+
+
+def run_job(job, until="", link_jobs=0, chainopts={}, shared=None):
+    c = Chain(job.kver, job.config, **chainopts)
+
+    # also if the chain fails: forked workers exit without running the
+    # finalizers of the temporary directories
+    try:
+        c.run(until = until, jobs = link_jobs, shared = shared)
+    finally:
+        c.cleanup()
+
+
+def run_group(group, until="", workers=1, link_jobs=0, chainopts={}):
+    '''Run the steps of a group, at most workers at the same time.
+    Failures are reported here. Returns a list of (job, exception) tuples
+    for the jobs that failed.
+    '''
+    import concurrent.futures
+
+    failed = []
+    steps = group.steps()
+    pending = list(steps)
+    running = {}
+
+    def finish(step, exc):
+        step.done = True
+        step.error = exc
+
+        if exc and step.job:
+            report_failure(step.job, exc)
+            failed.append((step.job, exc))
+
+    # chains don't change the working directory of the process, so the
+    # steps can run at the same time
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+            while pending or running:
+                for step in list(pending):
+                    if step.parent and not step.parent.done:
+                        continue
+
+                    pending.remove(step)
+
+                    # the jobs below a failed step fail with it
+                    if step.parent and step.parent.error:
+                        finish(step, step.parent.error)
+                    else:
+                        running[pool.submit(
+                            step.run, until, link_jobs, chainopts
+                        )] = step
+
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when = concurrent.futures.FIRST_COMPLETED
+                )
+
+                for fut in finished:
+                    finish(running.pop(fut), fut.exception())
+    finally:
+        for step in steps:
+            if step.chain:
+                step.chain.cleanup()
+
+    return failed
+
+
+# chain options that collect something, which workers send back
+collectors = [ "tracer", "metrics", "history", "transaction" ]
+
+
+def run_group_worker(group, until="", workers=1, link_jobs=0, chainopts={}):
+    '''run_group in a worker process. Returns its failures and what the
+    collectors in chainopts collected in the worker, for the parent to
+    merge.
+    '''
+    failed = run_group(group, until, workers, link_jobs, chainopts)
+
+    return failed, {
+        name: chainopts[name].collected()
+        for name in collectors if chainopts.get(name, None)
+    }
+
+
+def report_failure(job, exc):
+    print(f"ckis: chain {job} failed: {exc}", file=sys.stderr)
+
+    # errors raised on purpose carry a clear message, anything else is a bug
+    # in ckis or a module, so show where it came from
+    if not isinstance(exc, (ConfigError, ModuleError)):
+        traceback.print_exception(exc, file=sys.stderr)
+
+
+def run_jobs(jobs, until="", workers=1, link_jobs=0, **chainopts):
+    '''Run all jobs, at most workers at the same time. A failing job does
+    not stop the other jobs. Returns a list of (job, exception) tuples for
+    the jobs that failed. link_jobs limits the links run at once by every
+    chain. All other options are passed on to the chains.
+
+    Jobs whose chains start with the same links share the results of those
+    links, unless only part of the chains is run (until is set). If the
+    schedule option is "critical-path", the jobs that are expected to take
+    longest according to the history option are started first.
+    '''
+    failed = []
+
+    if until:
+        groups = [ JobGroup([ job ]) for job in jobs ]
+    else:
+        groups = group_jobs(jobs)
+
+    history = chainopts.get("history", None)
+    if chainopts.get("schedule", None) == "critical-path" and history:
+        groups = schedule_groups(groups, history)
+
+    if workers <= 1 or len(groups) <= 1:
+        for group in groups:
+            failed += run_group(group, until, workers, link_jobs, chainopts)
+
+        return failed
+
+
+    # Look up what is shared by all jobs before forking, so the workers
+    # inherit it instead of each of them doing it again.
+    search_esp_paths()
+    try:
+        get_osrelease()
+    except OSError:
+        # let the chains report this
+        pass
+
+    # Groups share nothing, so every group gets a process of its own, which
+    # keeps the work done in Python (hashing, packing initrds) of different
+    # groups from waiting for one interpreter. Within a group, the chains
+    # are threads, as they continue from the same chains in memory.
+    # Forking keeps the module metadata read while sanitizing the config.
+    import concurrent.futures
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("fork")
+
+    # every process gets its share of the workers, not all of them
+    share = max(1, workers // len(groups))
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers = workers, mp_context = ctx
+    ) as pool:
+        futures = {
+            pool.submit(
+                run_group_worker, group, until, share, link_jobs, chainopts
+            ): group
+            for group in groups
+        }
+
+        for fut in concurrent.futures.as_completed(futures):
+            group = futures[fut]
+
+            # failures of single jobs are reported by the worker
+            if exc := fut.exception():
+                for job in group.jobs:
+                    report_failure(job, exc)
+                    failed += [ (job, exc) ]
+            else:
+                group_failed, collected = fut.result()
+                failed += group_failed
+
+                for name, data in collected.items():
+                    chainopts[name].merge(data)
+
+    return failed
@@ -0,0 +1,179 @@
+import contextlib
+import os
+import select
+import shutil
+import threading
+import time
+
+from .util import parse_size
+
+
+# memory is handed out in tokens of this size
+mem_unit = 16 * 1024 * 1024
+
+default_cost = { "cpus": 1, "memory": 0 }
+
+
+def _put(pipe, n):
+    while n > 0:
+        n -= os.write(pipe[1], b"+" * min(n, 4096))
+
+
+def _take(pipe, n, deadline=None):
+    '''Take n tokens from pipe, waiting until deadline (a time.monotonic()
+    value) at most. If that passes, the tokens taken so far are put back and
+    TimeoutError is raised.
+    '''
+    taken = 0
+
+    try:
+        while taken < n:
+            left = None if deadline is None else deadline - time.monotonic()
+            if left is not None and left <= 0:
+                raise TimeoutError
+
+            select.select([ pipe[0] ], [], [], left)
+
+            # others may have been quicker
+            try:
+                taken += len(os.read(pipe[0], n - taken))
+            except BlockingIOError:
+                pass
+    except BaseException:
+        _put(pipe, taken)
+        raise
+
+
+def _take_free(pipe, n):
+    '''Take up to n tokens from pipe without waiting. Returns how many
+    were taken.
+    '''
+    if n <= 0:
+        return 0
+
+    try:
+        return len(os.read(pipe[0], n))
+    except BlockingIOError:
+        return 0
+
+
+class JobServer:
+    '''Limits the CPUs and memory used by the commands of all chains of a
+    run, like the jobserver of make. Slots are tokens in pipes, so the
+    jobserver works across the threads and forked processes of a run.
+
+    A command takes as many tokens as the cost its module declares in
+    'modcost', but never more than there are, so expensive commands still
+    run (on their own) on small machines.
+    '''
+
+    def __init__(self, cpus=None, memory=0, nice=None, ionice=None):
+        self.cpus = cpus or os.cpu_count() or 1
+        self.memory = memory // mem_unit
+        self.nice = nice
+        self.ionice = ionice
+
+        self._cpu = os.pipe()
+        self._mem = os.pipe()
+        _put(self._cpu, self.cpus)
+        _put(self._mem, self.memory)
+
+        # only one acquirer at a time may take tokens, otherwise two could
+        # each take part of what they need and wait for each other forever
+        self._lock = os.pipe()
+        _put(self._lock, 1)
+
+        # tokens are waited for with select, to be able to give up
+        for pipe in (self._cpu, self._mem, self._lock):
+            os.set_blocking(pipe[0], False)
+
+
+    def _tokens(self, cost):
+        cost = default_cost | cost
+
+        memory = cost["memory"]
+        if isinstance(memory, str):
+            memory = parse_size(memory)
+
+        cpus = min(cost["cpus"], self.cpus)
+        mem = min(-(-memory // mem_unit), self.memory)
+
+        return cpus, mem
+
+
+    @contextlib.contextmanager
+    def slot(self, cost={}, deadline=None):
+        '''Wait until there are enough CPUs and memory for cost, and hold
+        them until the context is left. Raises TimeoutError if they are not
+        there by deadline (a time.monotonic() value).
+        '''
+        cpus, mem = self._tokens(cost)
+
+        _take(self._lock, 1, deadline)
+        try:
+            _take(self._cpu, cpus, deadline)
+            try:
+                _take(self._mem, mem, deadline)
+            except BaseException:
+                _put(self._cpu, cpus)
+                raise
+        finally:
+            _put(self._lock, 1)
+
+        try:
+            yield
+        finally:
+            _put(self._cpu, cpus)
+            _put(self._mem, mem)
+
+
+    @contextlib.contextmanager
+    def cpu_slot(self, wanted=None, deadline=None):
+        '''Like slot, for work done in threads of this process rather than
+        by commands: wait for one CPU, and take up to wanted (all of them by
+        default) if they are free. Yields the number of CPUs taken.
+        '''
+        wanted = min(wanted or self.cpus, self.cpus)
+
+        _take(self._lock, 1, deadline)
+        try:
+            _take(self._cpu, 1, deadline)
+            cpus = 1 + _take_free(self._cpu, wanted - 1)
+        finally:
+            _put(self._lock, 1)
+
+        try:
+            yield cpus
+        finally:
+            _put(self._cpu, cpus)
+
+
+    def lower_priority(self):
+        '''Give the calling thread the nice level of the jobserver, for
+        threads doing the work of a cpu_slot. Linux keeps nice levels per
+        thread; there is no way to set the io priority from Python.
+        '''
+        if self.nice is None:
+            return
+
+        tid = threading.get_native_id()
+
+        try:
+            os.setpriority(
+                os.PRIO_PROCESS, tid,
+                os.getpriority(os.PRIO_PROCESS, tid) + self.nice
+            )
+        except OSError:
+            # a negative nice level needs privileges
+            pass
+
+
+    def wrap(self, cmd):
+        '''Prefix cmd so it runs with the priorities of the jobserver.'''
+        if self.nice is not None and shutil.which("nice"):
+            cmd = [ "nice", "-n", str(self.nice) ] + cmd
+
+        if self.ionice is not None and shutil.which("ionice"):
+            cmd = [ "ionice", "-c", str(self.ionice) ] + cmd
+
+        return cmd
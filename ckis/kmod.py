@@ -0,0 +1,250 @@
+import fnmatch
+import marshal
+import os
+import pathlib
+import stat
+
+from .errors import ModuleError
+
+
+default_sysfs = pathlib.Path("/sys")
+default_moddir = pathlib.Path("/usr/lib/modules")
+
+# the files of a module directory the index is built from
+index_files = [
+    "modules.alias", "modules.dep", "modules.builtin", "modules.softdep",
+]
+
+# alias patterns are grouped by up to this many of their first characters
+prefix_len = 16
+
+
+def module_name(path):
+    '''The name of the kernel module at path, e.g. "snd_hda_intel" for
+    kernel/sound/pci/hda/snd-hda-intel.ko.zst.
+    '''
+    name = os.path.basename(path)
+    return name[:name.index(".ko")].replace("-", "_")
+
+
+######## sysfs ########
+
+def host_aliases(sysfs=default_sysfs):
+    '''The modaliases of all devices of the host, from the modalias files
+    under sysfs/devices.
+    '''
+    aliases = set()
+
+    for root, dirs, files in os.walk(pathlib.Path(sysfs) / "devices"):
+        if "modalias" in files:
+            try:
+                with open(os.path.join(root, "modalias")) as f:
+                    if alias := f.read().strip():
+                        aliases.add(alias)
+            except OSError:
+                # e.g. removed in the meantime
+                pass
+
+    return aliases
+
+
+######## index ########
+
+def index_key(moddir):
+    '''What the index of module directory moddir depends on, for cache
+    keys.
+    '''
+    key = [ str(moddir), marshal.version ]
+
+    for name in index_files:
+        try:
+            st = os.stat(moddir / name)
+            key += [ (name, st.st_size, st.st_mtime_ns) ]
+        except FileNotFoundError:
+            key += [ (name, None) ]
+
+    return key
+
+
+def _prefix(pattern):
+    # the literal start of the pattern, before any wildcard
+    for i, c in enumerate(pattern[:prefix_len]):
+        if c in "*?[":
+            return pattern[:i]
+
+    return pattern[:prefix_len]
+
+
+def build_index(moddir):
+    '''Parse modules.alias, modules.dep, modules.builtin and
+    modules.softdep of module directory moddir into an index, a dict of
+    plain data that marshal can store:
+
+    - "aliases": alias patterns by their literal prefix (see _prefix), as
+      lists of (pattern, module name)
+    - "paths": the path of every module, relative to moddir, by its name
+    - "deps": the names of the modules every module directly depends on
+    - "builtin": the names of the modules built into the kernel
+    - "softdeps": the names of the modules every module wants loaded
+      before and after it, as a list of two lists
+    '''
+    aliases = {}
+    paths = {}
+    deps = {}
+    builtin = []
+    softdeps = {}
+
+    try:
+        with open(moddir / "modules.dep") as f:
+            for line in f:
+                path, sep, rest = line.partition(":")
+                if not sep:
+                    continue
+
+                name = module_name(path)
+                paths[name] = path
+                deps[name] = [ module_name(dep) for dep in rest.split() ]
+
+        with open(moddir / "modules.alias") as f:
+            for line in f:
+                match line.split():
+                    case [ "alias", pattern, name ]:
+                        aliases.setdefault(_prefix(pattern), []).append(
+                            (pattern, name)
+                        )
+    except OSError as e:
+        raise ModuleError(f"Cannot read the module index of {moddir}: {e}")
+
+    try:
+        with open(moddir / "modules.builtin") as f:
+            builtin = [ module_name(line) for line in f if line.strip() ]
+    except FileNotFoundError:
+        pass
+
+    # softdep <module> pre: <modules...> post: <modules...>
+    try:
+        with open(moddir / "modules.softdep") as f:
+            for line in f:
+                match line.split():
+                    case [ "softdep", name, *rest ]:
+                        pre, post = softdeps.setdefault(
+                            name.replace("-", "_"), [ [], [] ]
+                        )
+                        current = None
+                        for word in rest:
+                            if word == "pre:":
+                                current = pre
+                            elif word == "post:":
+                                current = post
+                            elif current is not None:
+                                current.append(word.replace("-", "_"))
+    except FileNotFoundError:
+        pass
+
+    return {
+        "aliases": aliases, "paths": paths, "deps": deps, "builtin": builtin,
+        "softdeps": softdeps,
+    }
+
+
+def write_index(index, path):
+    pathlib.Path(path).write_bytes(marshal.dumps(index))
+
+
+def read_index(path):
+    # marshal.load reads files in tiny pieces; reading it at once is
+    # several times faster
+    return marshal.loads(pathlib.Path(path).read_bytes())
+
+
+######## resolving ########
+
+def match_aliases(index, aliases):
+    '''The names of the modules with an alias pattern that matches any of
+    aliases. Built-in modules are left out, as there is nothing to load.
+    '''
+    buckets = index["aliases"]
+    paths = index["paths"]
+    names = set()
+
+    for alias in aliases:
+        # only patterns whose literal prefix is a prefix of the alias can
+        # match it
+        for i in range(min(len(alias), prefix_len) + 1):
+            for pattern, name in buckets.get(alias[:i], ()):
+                if name in paths and fnmatch.fnmatchcase(alias, pattern):
+                    names.add(name)
+
+    return names
+
+
+def resolve(index, names):
+    '''The paths of modules names and everything they depend on, relative
+    to the module directory, in the order they have to be loaded. Built-in
+    modules are left out; unknown modules are an error.
+
+    Soft dependencies are loaded before or after their module, if they
+    exist; like for modprobe, missing ones are no error.
+    '''
+    paths = index["paths"]
+    deps = index["deps"]
+    builtin = set(index["builtin"])
+    softdeps = index["softdeps"]
+
+    order = []
+    seen = set()
+
+    def visit(name):
+        if name in seen:
+            return
+        seen.add(name)
+
+        pre, post = softdeps.get(name, ( (), () ))
+
+        for dep in pre:
+            if dep in paths:
+                visit(dep)
+
+        for dep in deps[name]:
+            visit(dep)
+
+        order.append(paths[name])
+
+        for dep in post:
+            if dep in paths:
+                visit(dep)
+
+    for name in sorted(names):
+        name = name.replace("-", "_")
+
+        if name in paths:
+            visit(name)
+        elif name not in builtin:
+            raise ModuleError(f"Kernel module {name} not found!")
+
+    return order
+
+
+def initrd_entries(moddir, kver, paths):
+    '''The entries of an initrd (see ckis.cpio) for the modules at paths,
+    relative to moddir, together with the module index files of moddir.
+    '''
+    dest = pathlib.PurePosixPath("lib/modules", kver)
+    files = [ p.name for p in moddir.glob("modules.*") if p.is_file() ]
+
+    dirs = { dest, *dest.parents }
+    for path in paths:
+        dirs.update((dest / path).parents)
+    dirs.discard(pathlib.PurePosixPath("."))
+
+    entries = [
+        (str(d), stat.S_IFDIR | 0o755, 0, 0, None, None, 0)
+        for d in sorted(dirs)
+    ]
+    entries += [
+        (str(dest / path), stat.S_IFREG | 0o644, 0, 0, moddir / path,
+         None, 0)
+        for path in sorted(files) + list(paths)
+    ]
+
+    return entries
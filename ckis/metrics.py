@@ -0,0 +1,262 @@
+import threading
+import time
+
+from .modules import write_atomic
+from .util import get_classname
+
+
+def new_usage():
+    '''Resources used by the commands of a link, summed over all of them,
+    except for maxrss, which is the peak of the largest one.
+    '''
+    return {
+        "commands": 0,
+        "utime": 0.0,
+        "stime": 0.0,
+        "maxrss": 0,
+        "read": 0,
+        "written": 0,
+    }
+
+
+def add_usage(usage, rusage):
+    '''Add the resource usage of a child process, as returned by os.wait4,
+    to usage.
+    '''
+    usage["commands"] += 1
+    usage["utime"] += rusage.ru_utime
+    usage["stime"] += rusage.ru_stime
+
+    # in KiB on Linux
+    usage["maxrss"] = max(usage["maxrss"], rusage.ru_maxrss * 1024)
+
+    # in blocks of 512 bytes, no matter the filesystem
+    usage["read"] += rusage.ru_inblock * 512
+    usage["written"] += rusage.ru_oublock * 512
+
+
+def sum_usage(usages):
+    total = new_usage()
+
+    for usage in usages:
+        for key, val in usage.items():
+            if key == "maxrss":
+                total[key] = max(total[key], val)
+            else:
+                total[key] += val
+
+    return total
+
+
+# name, help, key in usage
+usage_metrics = [
+    ("commands", "Commands run.", "commands"),
+    ("cpu_user_seconds", "User CPU time of the commands.", "utime"),
+    ("cpu_system_seconds", "System CPU time of the commands.", "stime"),
+    ("max_rss_bytes", "Peak resident set size of the largest command.",
+        "maxrss"),
+    ("fs_read_bytes", "Bytes the commands read from filesystems.", "read"),
+    ("fs_written_bytes", "Bytes the commands wrote to filesystems.",
+        "written"),
+]
+
+
+def escape(val):
+    return (
+        str(val).replace("\\", "\\\\").replace("\"", "\\\"")
+        .replace("\n", "\\n")
+    )
+
+
+def format_labels(labels):
+    return ",".join(f'{key}="{escape(val)}"' for key, val in labels.items())
+
+
+class Metrics:
+    '''Collects the wall time and resource usage of every link and chain
+    that is run, and the sizes of the artifacts they produce, to be written
+    for the textfile collector of the Prometheus node_exporter.
+
+    Like a Tracer, it can be passed to worker processes, which start
+    without samples and send back what they collected.
+    '''
+
+    def __init__(self):
+        self.links = []
+        self.chains = []
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+
+    def add_link(self, chain, wall, ret):
+        '''Record a link run by chain, which took wall seconds and returned
+        the artifacts ret, or None if it failed.
+        '''
+        artifacts = []
+
+        for art in ret or []:
+            # installs staged in a transaction are not there yet
+            path = chain._staged.get(art.path, art.path)
+
+            if path.is_file():
+                artifacts += [{
+                    "type": get_classname(art),
+                    # files in the working directory of the link have a
+                    # different path every time
+                    "path": str(art.path) if art.installed else art.path.name,
+                    "size": path.stat().st_size,
+                }]
+
+        sample = {
+            "kver": chain.kver,
+            "link": chain.link,
+            "wall": wall,
+            "success": ret is not None,
+            "cached": chain._from_cache,
+            "usage": dict(chain._usage),
+            "artifacts": artifacts,
+            "shared": len(chain.members) > 1,
+        }
+
+        # a link shared by several chains counts for each of them
+        with self._lock:
+            self.links += [
+                sample | { "chain": name } for name in chain.members
+            ]
+
+
+    def add_chain(self, chain, wall, success):
+        '''Record a chain that took wall seconds. The chains a shared chain
+        ran for include it in their own samples, unless it failed and they
+        never ran.
+        '''
+        if len(chain.members) > 1 and success:
+            return
+
+        with self._lock:
+            self.chains += [
+                {
+                    "chain": name,
+                    "kver": chain.kver,
+                    "wall": wall,
+                    "success": success,
+                }
+                for name in chain.members
+            ]
+
+
+    def collected(self):
+        with self._lock:
+            return { "links": list(self.links), "chains": list(self.chains) }
+
+
+    def merge(self, collected):
+        with self._lock:
+            self.links += collected["links"]
+            self.chains += collected["chains"]
+
+
+    def format(self):
+        '''The collected metrics in the text exposition format.'''
+        lines = []
+
+        def metric(name, help, samples):
+            lines.extend([
+                f"# HELP ckis_{name} {help}",
+                f"# TYPE ckis_{name} gauge",
+            ])
+            for labels, val in samples:
+                if labels:
+                    labels = f"{{{format_labels(labels)}}}"
+                lines.append(f"ckis_{name}{labels or ""} {val}")
+
+        with self._lock:
+            links = list(self.links)
+            chains = list(self.chains)
+
+        def chain_labels(s):
+            return { "chain": s["chain"], "kver": s["kver"] }
+
+        def link_labels(s):
+            # shared links have the same values in each of their chains
+            return chain_labels(s) | {
+                "link": s["link"],
+                "shared": str(s["shared"]).lower(),
+            }
+
+        metric(
+            "link_wall_seconds", "Wall time of the link.",
+            [ (link_labels(s), s["wall"]) for s in links ]
+        )
+        metric(
+            "link_success", "Whether the link succeeded.",
+            [ (link_labels(s), int(s["success"])) for s in links ]
+        )
+        metric(
+            "link_cached", "Whether the link was restored from the cache.",
+            [ (link_labels(s), int(s["cached"])) for s in links ]
+        )
+
+        for name, help, key in usage_metrics:
+            metric(
+                f"link_{name}", help,
+                [ (link_labels(s), s["usage"][key]) for s in links ]
+            )
+
+        metric(
+            "artifact_size_bytes", "Size of an artifact produced by a link.",
+            [
+                (link_labels(s) | { "type": a["type"], "path": a["path"] },
+                 a["size"])
+                for s in links for a in s["artifacts"]
+            ]
+        )
+
+        # the commands of a chain, over all of its links
+        usage = {}
+        for s in links:
+            usage.setdefault(
+                (s["chain"], s["kver"]), []
+            ).append(s["usage"])
+
+        metric(
+            "chain_wall_seconds", "Wall time of the chain.",
+            [ (chain_labels(s), s["wall"]) for s in chains ]
+        )
+        metric(
+            "chain_success", "Whether the chain succeeded.",
+            [ (chain_labels(s), int(s["success"])) for s in chains ]
+        )
+
+        for name, help, key in usage_metrics:
+            metric(
+                f"chain_{name}", help,
+                [
+                    ({ "chain": chain, "kver": kver }, sum_usage(u)[key])
+                    for (chain, kver), u in usage.items()
+                ]
+            )
+
+        metric(
+            "run_wall_seconds", "Wall time of the whole run.",
+            [ ({}, time.monotonic() - self._start) ]
+        )
+        metric(
+            "run_timestamp_seconds", "When the run finished.",
+            [ ({}, time.time()) ]
+        )
+
+        return "\n".join(lines) + "\n"
+
+
+    def write(self, path):
+        # the collector may read the file at any time, so never let it see
+        # a half-written one; it typically doesn't run as root
+        write_atomic(path, self.format().encode(), mode=0o644)
@@ -1,64 +1,290 @@
-import pathlib
+import ast
+import hashlib
 import importlib.util
+import json
+import marshal
+import os
+import pathlib
+import tempfile
 
 from .errors import ConfigError
+from .util import parse_size
 
 module_cache = {}
 
-def find_module(name):
-    moddirs = [
-        "/etc/ckis/modules",
-        "/usr/local/lib/ckis/modules",
-        "/usr/lib/ckis/modules",
-    ]
+# modules in earlier directories take precedence
+moddirs = [
+    "/etc/ckis/modules",
+    "/usr/local/lib/ckis/modules",
+    "/usr/lib/ckis/modules",
+]
+
+# Where to keep the module index and compiled modules; set by the runner.
+# Never in the module directories themselves, so they stay clean.
+cachedir = None
+
+module_index = None
+
+
+def scan_moddirs():
+    '''Find all modules in the module directories. Returns an index
+    mapping module names to their paths, with the mtimes of all directories
+    that were scanned.
+    '''
+    dirs = {}
+    modules = {}
 
     for moddir in moddirs:
-        path = pathlib.Path(moddir) / (name + ".py")
-        if path.is_file():
-            return path
+        try:
+            dirs[moddir] = os.stat(moddir).st_mtime_ns
+        except OSError:
+            # it may be created later
+            dirs[moddir] = None
+            continue
+
+        for root, subdirs, files in os.walk(moddir, followlinks=True):
+            dirs[root] = os.stat(root).st_mtime_ns
+
+            # e.g. __pycache__ or .git
+            subdirs[:] = [
+                d for d in subdirs if not d.startswith(("_", "."))
+            ]
+
+            for f in sorted(files):
+                if f.endswith(".py"):
+                    name = os.path.relpath(
+                        os.path.join(root, f.removesuffix(".py")), moddir
+                    )
+                    modules.setdefault(name, os.path.join(root, f))
+
+    return { "moddirs": list(moddirs), "dirs": dirs, "modules": modules }
+
+
+def index_valid(index):
+    # adding, removing or renaming a module changes the mtime of its
+    # directory
+    if index.get("moddirs", None) != moddirs:
+        return False
+
+    for d, mtime in index["dirs"].items():
+        try:
+            if os.stat(d).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            if mtime is not None:
+                return False
+
+    return True
+
+
+def write_atomic(path, data, mode=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(prefix=".new-", dir=path.parent)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+        if mode is not None:
+            os.fchmod(f.fileno(), mode)
+    os.rename(tmp, path)
+
+
+def get_module_index():
+    global module_index
+
+    # the index is checked against the module directories once, when it is
+    # loaded; modules don't come and go during a run
+    if module_index and module_index["moddirs"] == moddirs:
+        return module_index
+
+    index = None
+
+    if cachedir:
+        try:
+            with open(cachedir / "index.json") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    if not index or not index_valid(index):
+        index = scan_moddirs()
+
+        if cachedir:
+            try:
+                write_atomic(
+                    cachedir / "index.json", json.dumps(index).encode()
+                )
+            except OSError:
+                # not running as root; just scan again next time
+                pass
+
+    module_index = index
+    return index
+
+
+def find_module(name):
+    if path := get_module_index()["modules"].get(name, None):
+        return pathlib.Path(path)
 
     # no module found
     return None
 
 
+def load_code(path):
+    '''Get the code object of the module at path. Compiled modules are
+    kept in the cache directory and used as long as the hash of the source
+    matches.
+    '''
+    source = path.read_bytes()
+    header = importlib.util.MAGIC_NUMBER + importlib.util.source_hash(source)
+
+    if cachedir:
+        name = hashlib.sha256(str(path).encode()).hexdigest() + ".pyc"
+        cfile = cachedir / "bytecode" / name
+
+        try:
+            data = cfile.read_bytes()
+            if data.startswith(header):
+                return marshal.loads(data[len(header):])
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+
+    code = compile(source, str(path), "exec", dont_inherit=True)
+
+    if cachedir:
+        try:
+            write_atomic(cfile, header + marshal.dumps(code))
+        except OSError:
+            pass
+
+    return code
+
+
 # path needs to be a pathlib.Path
 def import_path(path):
     modname = path.name.removesuffix(".py")
     modspec = importlib.util.spec_from_file_location(modname, path)
     mod = importlib.util.module_from_spec(modspec)
-    modspec.loader.exec_module(mod)
+    exec(load_code(path), mod.__dict__)
 
     return mod
+
+
+def compile_modules():
+    '''Index and compile all modules in the search path ahead of time.
+    Returns the number of modules.
+    '''
+    modules = get_module_index()["modules"]
+
+    for path in modules.values():
+        load_code(pathlib.Path(path))
+
+    return len(modules)
     
 
 
+def get_module_path(link):
+    modpath = find_module(link)
+
+    if not modpath:
+        raise ConfigError(
+            f"Module {link} not found in search path!"
+        )
+
+    return modpath
+
+
 def get_module(link):
     global module_cache
 
     if link in module_cache:
         return module_cache[link]
     else:
-        modpath = find_module(link)
-
-        if not modpath:
-            raise ConfigError(
-                f"Module {link} not found in search path!"
-            )
-        
-        mod = import_path(modpath)
+        mod = import_path(get_module_path(link))
         validate_module(mod)
         module_cache[link] = mod  # cache the module
         return mod
 
 
+
+######## static module metadata ########
+
+info_cache = {}
+
+
+class ModuleInfo:
+    '''The fields of a module (modname, inputs, ...), read from its source
+    without executing it. Validates like the module itself, so everything
+    that only needs the fields can use this instead.
+    '''
+
+    def __init__(self, path):
+        self.__file__ = str(path)
+        self._functions = set()
+
+        tree = ast.parse(pathlib.Path(path).read_bytes(), str(path))
+
+        for node in tree.body:
+            match node:
+                case ast.FunctionDef(name=name):
+                    self._functions.add(name)
+                    continue
+                case ast.Assign(targets=[ ast.Name(id=name) ], value=value):
+                    pass
+                case ast.AnnAssign(target=ast.Name(id=name), value=value):
+                    if value is None:
+                        continue
+                case _:
+                    # functions, imports, docstrings, ...
+                    continue
+
+            if name.startswith("_"):
+                # private fields starting with "_" are allowed
+                continue
+
+            try:
+                val = ast.literal_eval(value)
+            except ValueError:
+                if name in mod_fields:
+                    raise ValueError(
+                        f"{path}: '{name}' should be a literal value!"
+                    )
+
+                # could be a function, which is allowed; if not, it is
+                # caught when the module is imported
+                continue
+
+            setattr(self, name, val)
+
+
+    def defines(self, name):
+        '''Whether the module defines a function name, e.g. cachekey.'''
+        return name in self._functions
+
+
+def get_module_info(link):
+    global info_cache
+
+    if link in info_cache:
+        return info_cache[link]
+    else:
+        info = ModuleInfo(get_module_path(link))
+        validate_module(info)
+        info_cache[link] = info
+        return info
+
+
 mod_fields = [
     "modname",
     "moddesc",
     "modoptions",
+    "modcost",
     "config",
     "optconfig",
     "inputs",
     "optinputs",
+    "outputs",
+    "installs",
+    "cacheable",
 ]
 
 def validate_module(mod):
@@ -66,11 +292,16 @@ def validate_module(mod):
     # ! modname
     # ! moddesc
     # ? modoptions
+    # ? modcost
     # ? config
     # ? optconfig
     # ? inputs
     # ? optinputs
+    # ? outputs
+    # ? installs
+    # ? cacheable
     # ? fire (the function)
+    # ? cachekey (the function)
 
 
     if hasattr(mod, "modname"):
@@ -88,10 +319,19 @@ def validate_module(mod):
     if hasattr(mod, "modoptions"):
         validate_modoptions(mod)
 
-    for field in ("config", "optconfig", "inputs", "optinputs"):
+    if hasattr(mod, "modcost"):
+        validate_modcost(mod)
+
+    for field in ("config", "optconfig", "inputs", "optinputs", "outputs"):
         if hasattr(mod, field):
             validate_set_of_strings(mod, field)
     
+    if hasattr(mod, "installs"):
+        validate_installs(mod)
+
+    if hasattr(mod, "cacheable"):
+        validate_cacheable(mod)
+
     if (hasattr(mod, "config")
         and hasattr(mod, "optconfig")
         and len(mod.config & mod.optconfig) > 0
@@ -143,6 +383,31 @@ def validate_modoptions(mod):
         )
 
 
+def validate_modcost(mod):
+    modcost = mod.modcost
+
+    if type(modcost) != dict:
+        raise TypeError(f"{mod.modname}: 'modcost' should be a dict!")
+
+    for key, val in modcost.items():
+        match key:
+            case "cpus":
+                if type(val) != int or val < 0:
+                    raise TypeError(
+                        f"{mod.modname}: modcost 'cpus' should be a"
+                        " positive int!"
+                    )
+            case "memory":
+                try:
+                    parse_size(val) if type(val) == str else int(val)
+                except (TypeError, ValueError):
+                    raise TypeError(
+                        f"{mod.modname}: modcost 'memory' should be a size!"
+                    )
+            case _:
+                raise ValueError(f"{mod.modname}: unknown modcost '{key}'!")
+
+
 def validate_modname(mod):
     modname = mod.modname
 
@@ -162,6 +427,17 @@ def validate_moddesc(mod):
 
 
 
+def validate_installs(mod):
+    if type(mod.installs) != bool:
+        raise TypeError(f"{mod.modname}: 'installs' should be a bool!")
+
+
+def validate_cacheable(mod):
+    if type(mod.cacheable) != bool:
+        raise TypeError(f"{mod.modname}: 'cacheable' should be a bool!")
+
+
+
 def validate_vars(mod):
     global mod_fields
     
@@ -0,0 +1,242 @@
+import contextlib
+import hashlib
+import mmap
+import os
+import pathlib
+import struct
+
+from .errors import ModuleError
+
+
+# PE/COFF, as far as it is needed to add sections to an EFI stub; see the
+# PE format specification (Microsoft)
+
+section_header = struct.Struct("<8sIIIIIIHHI")
+
+# IMAGE_SCN_CNT_INITIALIZED_DATA | IMAGE_SCN_MEM_READ
+data_characteristics = 0x40000040
+
+# index of the certificate table in the data directories
+security_dir = 4
+
+
+def align(n, alignment):
+    return (n + alignment - 1) // alignment * alignment
+
+
+class PEImage:
+    '''The headers of a PE image, read from data. Only what is needed to
+    append sections is parsed; everything else is kept as it is.
+    '''
+
+    def __init__(self, data):
+        try:
+            self._parse(data)
+        except struct.error:
+            raise ModuleError("Not a PE image: truncated headers!")
+
+
+    def _parse(self, data):
+        if data[:2] != b"MZ":
+            raise ModuleError("Not a PE image: no DOS header!")
+
+        self.pe = struct.unpack_from("<I", data, 0x3c)[0]
+
+        if data[self.pe:self.pe + 4] != b"PE\0\0":
+            raise ModuleError("Not a PE image: no PE signature!")
+
+        self.coff = self.pe + 4
+        self.nsections, = struct.unpack_from("<H", data, self.coff + 2)
+        self.optsize, = struct.unpack_from("<H", data, self.coff + 16)
+
+        self.opt = self.coff + 20
+        magic, = struct.unpack_from("<H", data, self.opt)
+
+        match magic:
+            case 0x10b: # PE32
+                self.datadirs = self.opt + 96
+            case 0x20b: # PE32+
+                self.datadirs = self.opt + 112
+            case _:
+                raise ModuleError(f"Unknown PE optional header {magic:#x}!")
+
+        (self.section_alignment, self.file_alignment) = struct.unpack_from(
+            "<II", data, self.opt + 32
+        )
+        (self.image_size, self.headers_size) = struct.unpack_from(
+            "<II", data, self.opt + 56
+        )
+        self.ndatadirs, = struct.unpack_from("<I", data, self.datadirs - 4)
+
+        self.sectab = self.opt + self.optsize
+        self.sections = [
+            section_header.unpack_from(data, self.sectab + i * 40)
+            for i in range(self.nsections)
+        ]
+
+
+    def section_names(self):
+        return [ s[0].rstrip(b"\0").decode() for s in self.sections ]
+
+
+    def raw_end(self):
+        '''The end of the data of the sections in the file. Anything after
+        it, like the signature of a signed stub, is not part of the image.
+        '''
+        return max(
+            (s[4] + s[3] for s in self.sections), default=self.headers_size
+        )
+
+
+    def virtual_end(self):
+        return max(
+            (s[2] + max(s[1], s[3]) for s in self.sections),
+            default=self.headers_size
+        )
+
+
+def section_size(source):
+    if isinstance(source, bytes):
+        return len(source)
+    else:
+        return os.stat(source).st_size
+
+
+@contextlib.contextmanager
+def open_section(source):
+    '''Map the contents of a section, which is bytes or a path, so they
+    can be written without reading them into memory first.
+    '''
+    if isinstance(source, bytes):
+        yield source
+        return
+
+    with open(source, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be mapped
+            yield b""
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            m.madvise(mmap.MADV_SEQUENTIAL)
+            yield m
+
+
+def add_sections(stub, sections, outp):
+    '''Write the PE image stub with sections appended to it to outp, e.g.
+    to build a unified kernel image from the systemd EFI stub. sections is
+    a list of (name, source) tuples, where source is bytes or the path of
+    a file. Files are mapped and written directly, so the output is written
+    in one sequential pass.
+
+    The stub needs room in its headers for the new section table entries.
+    A signature of the stub is dropped, as it would not be valid anyway.
+    '''
+    stub = pathlib.Path(stub)
+    data = bytearray(stub.read_bytes())
+    img = PEImage(data)
+
+    names = img.section_names()
+    for name, _ in sections:
+        if len(name.encode()) > 8:
+            raise ModuleError(f"PE section name {name} is too long!")
+        if name in names:
+            raise ModuleError(f"{stub} already has a {name} section!")
+
+    table_end = img.sectab + 40 * (img.nsections + len(sections))
+    if table_end > img.headers_size:
+        raise ModuleError(f"No room for {len(sections)} sections in {stub}!")
+
+    # lay out the new sections after those of the stub
+    raw = align(img.raw_end(), img.file_alignment)
+    virt = align(img.virtual_end(), img.section_alignment)
+    layout = []
+    initialized = 0
+
+    for i, (name, source) in enumerate(sections):
+        size = section_size(source)
+        rawsize = align(size, img.file_alignment)
+
+        section_header.pack_into(
+            data, img.sectab + 40 * (img.nsections + i),
+            name.encode(), size, virt, rawsize, raw, 0, 0, 0, 0,
+            data_characteristics
+        )
+        layout += [ (raw, size, rawsize, source) ]
+
+        initialized += rawsize
+        raw += rawsize
+        virt = align(virt + size, img.section_alignment)
+
+    # fix up the headers for the new sections
+    struct.pack_into(
+        "<H", data, img.coff + 2, img.nsections + len(sections)
+    )
+    size_of_data, = struct.unpack_from("<I", data, img.opt + 8)
+    struct.pack_into("<I", data, img.opt + 8, size_of_data + initialized)
+    struct.pack_into("<I", data, img.opt + 56, virt)
+
+    # the checksum is not checked by firmware, and signing sets it
+    struct.pack_into("<I", data, img.opt + 64, 0)
+
+    if img.ndatadirs > security_dir:
+        struct.pack_into("<II", data, img.datadirs + 8 * security_dir, 0, 0)
+
+    with open(outp, "wb") as out:
+        out.write(memoryview(data)[:img.raw_end()])
+
+        for offset, size, rawsize, source in layout:
+            out.write(bytes(offset - out.tell()))
+
+            with open_section(source) as contents:
+                out.write(contents)
+
+        out.write(bytes(raw - out.tell()))
+
+    return outp
+
+
+def authenticode_digest(path, algorithm="sha256"):
+    '''The Authenticode digest of the PE image at path, which is what a
+    signature of it signs: the image without its checksum and signatures.
+    Images that only differ in those, e.g. a signed and an unsigned kernel,
+    have the same digest. The file is mapped and hashed without copying.
+    '''
+    if os.stat(path).st_size == 0:
+        raise ModuleError("Not a PE image: empty file!")
+
+    with (
+        open(path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m,
+        memoryview(m) as view,
+    ):
+        img = PEImage(m)
+        h = hashlib.new(algorithm)
+
+        checksum = img.opt + 64
+        certdir = img.datadirs + 8 * security_dir
+
+        # the headers, without the checksum and the certificate table entry
+        h.update(view[:checksum])
+
+        if img.ndatadirs > security_dir:
+            h.update(view[checksum + 4:certdir])
+            h.update(view[certdir + 8:img.headers_size])
+            certsize, = struct.unpack_from("<I", m, certdir + 4)
+        else:
+            h.update(view[checksum + 4:img.headers_size])
+            certsize = 0
+
+        # the sections, in the order they are in the file
+        end = img.headers_size
+        for section in sorted(img.sections, key=lambda s: s[4]):
+            rawsize, offset = section[3], section[4]
+
+            if rawsize:
+                h.update(view[offset:offset + rawsize])
+                end = max(end, offset + rawsize)
+
+        # anything after them, except the certificates, which come last
+        h.update(view[end:len(m) - certsize])
+
+    return h.hexdigest()
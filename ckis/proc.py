@@ -0,0 +1,130 @@
+import os
+import signal
+import subprocess
+import threading
+
+
+default_logsize = 64 * 1024
+
+# time a child gets to exit after SIGTERM, before it is killed
+kill_grace = 5
+
+
+class RingLog:
+    '''Log that only keeps the last size bytes written to it.'''
+
+    def __init__(self, size=default_logsize):
+        self.size = size
+        self._buf = bytearray()
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._buf += data
+
+            if len(self._buf) > self.size:
+                del self._buf[:len(self._buf) - self.size]
+
+    def getvalue(self):
+        with self._lock:
+            return bytes(self._buf)
+
+    def tail(self, lines=20):
+        text = self.getvalue().decode(errors="replace")
+        return "\n".join(text.splitlines()[-lines:])
+
+
+def _read(loop, fd, done, log, captured):
+    try:
+        data = os.read(fd, 65536)
+    except BlockingIOError:
+        return
+
+    if data:
+        log.write(data)
+        if captured is not None:
+            captured += [ data ]
+    else:
+        # a pipe at EOF is always readable; don't get called for it again
+        loop.remove_reader(fd)
+        if not done.done():
+            done.set_result(None)
+
+
+async def _terminate(proc, exited):
+    import asyncio
+
+    # the child runs in its own process group, so this also gets whatever
+    # it started itself
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        await asyncio.wait_for(asyncio.shield(exited), kill_grace)
+    except TimeoutError:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def run_process(cmd, log, capture=False, timeout=None, **kwargs):
+    '''Run cmd, streaming its stdout and stderr into log. Popen arguments
+    can be given as keyword arguments. Raises TimeoutError if the child did
+    not finish within timeout seconds; the child is then killed, as it is
+    when the calling task is cancelled.
+
+    Returns the exit code, the complete stdout and stderr if capture is
+    set (None otherwise), and the resource usage of the child.
+    '''
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+
+    kwargs.setdefault("stdin", subprocess.DEVNULL)
+    proc = subprocess.Popen(
+        cmd,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
+        process_group = 0,
+        **kwargs
+    )
+
+    pipes = [ proc.stdout.fileno(), proc.stderr.fileno() ]
+    captured = { fd: [] if capture else None for fd in pipes }
+    eofs = []
+
+    for fd in pipes:
+        os.set_blocking(fd, False)
+        eofs += [ loop.create_future() ]
+        loop.add_reader(fd, _read, loop, fd, eofs[-1], log, captured[fd])
+
+    pidfd = os.pidfd_open(proc.pid)
+    exited = loop.create_future()
+    loop.add_reader(
+        pidfd, lambda: exited.done() or exited.set_result(None)
+    )
+
+    try:
+        async with asyncio.timeout(timeout):
+            # unlike gather, wait doesn't cancel the futures when it is
+            # cancelled, so we can still wait for the child to exit
+            await asyncio.wait([ exited, *eofs ])
+    except (TimeoutError, asyncio.CancelledError):
+        await _terminate(proc, exited)
+        raise
+    finally:
+        for fd in pipes + [ pidfd ]:
+            loop.remove_reader(fd)
+        os.close(pidfd)
+
+        # reap the child ourselves, to get its resource usage
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        proc.stdout.close()
+        proc.stderr.close()
+
+    if capture:
+        out, err = (b"".join(captured[fd]) for fd in pipes)
+    else:
+        out, err = None, None
+
+    return proc.returncode, out, err, rusage
@@ -1,10 +1,17 @@
 import argparse
+import pathlib
 import sys
-import tomllib
 
-from .config import load_config, sanitize_config
-from .errors import ConfigError
-from .chain import Chain
+from . import modules
+from .cache import Cache, default_cachedir, default_cachesize
+from .config import find_config, load_sanitized_config
+from .errors import ConfigError, InstallError
+from .history import History
+from .jobs import Job, group_jobs, plan_job, run_jobs
+from .metrics import Metrics
+from .proc import default_logsize
+from .trace import Tracer, span
+from .util import find_kernels, format_size, parse_size
 
 
 def handle_options():
@@ -17,6 +24,21 @@ def handle_options():
         type = argparse.FileType(mode = 'rb'),
         help = "configuration file to use"
     )
+    parser.add_argument(
+        "--cache-dir",
+        metavar = "dir",
+        type = pathlib.Path,
+        default = default_cachedir,
+        help = f"directory to cache results in (default: {default_cachedir})"
+    )
+    parser.add_argument(
+        "--cache-size",
+        metavar = "size",
+        type = parse_size,
+        default = default_cachesize,
+        help = "maximum size of the cache, e.g. 512M or 2G (default: "
+               f"{format_size(default_cachesize)})"
+    )
 
 
     subparsers = parser.add_subparsers(
@@ -29,32 +51,204 @@ def handle_options():
 
     parser_run = subparsers.add_parser("run", help = "run one or more chains")
 
+    add_job_options(parser_run)
+
     parser_run.add_argument(
-        "kver",
+        "-u",
+        "--until",
         type = str,
-        help = "kernel version to run chain for"
+        default = "",
+        help = "run until the specified link (globbing is supported)"
+    )
+    parser_run.add_argument(
+        "-j",
+        "--jobs",
+        type = int,
+        default = 1,
+        metavar = "N",
+        help = "run up to N chains at the same time"
+    )
+    parser_run.add_argument(
+        "-l",
+        "--link-jobs",
+        type = int,
+        default = 0,
+        metavar = "N",
+        help = "run up to N independent links of a chain at the same time"
+               " (default: no limit)"
+    )
+    parser_run.add_argument(
+        "--durability",
+        choices = [ "fast", "safe" ],
+        default = "safe",
+        help = "whether to sync installed files to disk (safe) or leave it"
+               " to the kernel (fast)"
+    )
+    parser_run.add_argument(
+        "--install",
+        choices = [ "transaction", "direct" ],
+        default = "transaction",
+        help = "write the installs of all chains together at the end of the"
+               " run, only if all of them fit (transaction), or let every"
+               " link write them right away (direct)"
+               " (default: transaction)"
     )
     parser_run.add_argument(
+        "-t",
+        "--link-timeout",
+        type = float,
+        metavar = "seconds",
+        help = "kill links that take longer than this"
+    )
+    parser_run.add_argument(
+        "--log-size",
+        type = parse_size,
+        default = default_logsize,
+        metavar = "size",
+        help = "how much of the output of its commands to keep per link"
+               f" (default: {format_size(default_logsize)})"
+    )
+    parser_run.add_argument(
+        "-v",
+        "--verbose",
+        action = "store_true",
+        help = "show the output of the commands run by links"
+    )
+    parser_run.add_argument(
+        "--cpus",
+        type = int,
+        metavar = "N",
+        help = "number of CPUs the commands of all chains may use together"
+               " (default: all)"
+    )
+    parser_run.add_argument(
+        "--memory",
+        type = parse_size,
+        default = 0,
+        metavar = "size",
+        help = "memory budget for the commands of all chains together, as"
+               " declared by their modules (default: no limit)"
+    )
+    parser_run.add_argument(
+        "--nice",
+        type = int,
+        metavar = "N",
+        help = "run commands with niceness N"
+    )
+    parser_run.add_argument(
+        "--ionice",
+        choices = [ "idle", "best-effort" ],
+        help = "run commands in this I/O scheduling class"
+    )
+    parser_run.add_argument(
+        "--trace",
+        type = pathlib.Path,
+        metavar = "file",
+        help = "record what every chain and link spends its time on, and"
+               " write it to file in Chrome trace format (for Perfetto)"
+    )
+    parser_run.add_argument(
+        "--metrics",
+        type = pathlib.Path,
+        metavar = "file",
+        help = "write the wall time and resource usage of every link and"
+               " chain, and the sizes of their artifacts, to file for the"
+               " node_exporter textfile collector"
+    )
+    parser_run.add_argument(
+        "--schedule",
+        choices = [ "order", "critical-path" ],
+        default = "order",
+        help = "start chains and links in the configured order, or those"
+               " on the longest path according to earlier runs first"
+               " (default: order)"
+    )
+    parser_run.add_argument(
+        "--sign-jobs",
+        type = int,
+        default = 0,
+        metavar = "N",
+        help = "sign the images of all chains through one signer, running up"
+               " to N signing commands at once and signing identical images"
+               " once (default: every link signs on its own)"
+    )
+    parser_run.add_argument(
+        "--no-cache",
+        action = "store_true",
+        help = "always fire links, don't use or update the cache"
+    )
+
+
+    parser_plan = subparsers.add_parser(
+        "plan",
+        help = "show the links that would be run, with the time they are"
+               " expected to take, without running anything"
+    )
+
+    add_job_options(parser_plan)
+
+
+    subparsers.add_parser(
+        "check",
+        help = "check the configuration and all modules, without running"
+               " any module code"
+    )
+
+    subparsers.add_parser(
+        "compile-modules",
+        help = "index and compile all modules into the cache"
+    )
+
+
+    parser_cache = subparsers.add_parser(
+        "cache", help = "inspect or clean up the cache"
+    )
+
+    parser_cache.add_argument(
+        "action",
+        choices = [ "stats", "prune" ],
+        help = "show cache usage, or evict entries until the cache is no"
+               " larger than --cache-size"
+    )
+    
+    args = parser.parse_args()
+
+    if args.cmd in ("run", "plan"):
+        sub = parser_run if args.cmd == "run" else parser_plan
+
+        if args.all and args.kver:
+            sub.error("kernel versions can't be combined with --all")
+        elif not args.all and not args.kver:
+            sub.error("no kernel version specified")
+
+    return args
+
+
+def add_job_options(parser):
+    parser.add_argument(
+        "kver",
+        type = str,
+        nargs = "*",
+        help = "kernel versions to run the chains for"
+    )
+    parser.add_argument(
+        "-a",
+        "--all",
+        action = "store_true",
+        help = "run the chains for all kernels in /usr/lib/modules"
+    )
+    parser.add_argument(
         "-c",
         "--chain",
         type = str,
         action = "append",
         help = "run only the specified chains"
     )
-    parser_run.add_argument(
-        "-u",
-        "--until",
-        type = str,
-        default = "",
-        help = "run until the specified link (globbing is supported)"
-    )
-    
-    return parser.parse_args()
 
 
 def get_chains(chains, conf):
     args_chain_names = set(chains) # don't handle the same chain twice
-    conf_chain_names = map(lambda c: c["name"], conf["chains"])
+    conf_chain_names = [ c["name"] for c in conf["chains"] ]
 
     ret = []
 
@@ -69,38 +263,254 @@ def get_chains(chains, conf):
 
 
 
-def do_run(args, conf):
+def get_cache(args):
+    cache = Cache(args.cache_dir / "links", args.cache_size)
+
+    # running as an unprivileged user is not an error; just don't cache
+    if cache.writable():
+        return cache
+    else:
+        return None
+
+
+def do_cache(args):
+    cache = Cache(args.cache_dir / "links", args.cache_size)
+
+    match args.action:
+        case "stats":
+            stats = cache.stats()
+            print(f"directory: {cache.root}")
+            print(f"entries:   {stats["entries"]}")
+            print(f"size:      {format_size(stats["size"])}")
+            print(f"maximum:   {format_size(stats["maxsize"])}")
+
+        case "prune":
+            evicted = cache.prune()
+            print(f"evicted {evicted} entries")
+
+    return 0
+
+
+def get_jobserver(args):
+    from .jobserver import JobServer
+
+    ioclasses = { "best-effort": 2, "idle": 3 }
+
+    return JobServer(
+        cpus = args.cpus,
+        memory = args.memory,
+        nice = args.nice,
+        ionice = ioclasses.get(args.ionice, None),
+    )
+
+
+def get_history(args):
+    history = History(args.cache_dir / "history.sqlite")
+
+    # like the cache, only kept when running as root
+    if history.writable():
+        return history
+    else:
+        return None
+
+
+def get_jobs(args, conf):
     if args.chain:
         chains = get_chains(args.chain, conf)
     else:
         chains = conf["chains"]
 
+    if args.all:
+        kvers = find_kernels()
+        if not kvers:
+            raise ConfigError("No kernels found in /usr/lib/modules!")
+    else:
+        # keep the order given, but don't run the same kernel twice
+        kvers = list(dict.fromkeys(args.kver))
+
+    # every chain has to run for every kernel
+    return [
+        Job(kver, chaincfg) for kver in kvers for chaincfg in chains
+    ]
+
+
+def format_duration(duration):
+    return "?" if duration is None else f"{duration:.1f}s"
+
+
+def do_plan(args, conf):
+    history = get_history(args)
+
+    for group in group_jobs(get_jobs(args, conf)):
+        for jobs, links in group.shared():
+            names = ", ".join(map(str, jobs))
+            print(f"shared by {names}: {", ".join(links)}")
+
+        for job in group.jobs:
+            links = job.config["links"]
+            deps, durations, length, path = plan_job(job, history)
+
+            if durations:
+                print(f"{job}: {format_duration(length)} expected")
+                print(f"  critical path: {" -> ".join(path)}")
+            else:
+                print(f"{job}: never ran before")
+
+            for link in links:
+                duration = format_duration(durations.get(link, None))
+                after = ", ".join(dep for dep in links if dep in deps[link])
+
+                print(
+                    f"  {link:24} {duration:>8}"
+                    + (f"  after {after}" if after else "")
+                )
 
+    return 0
 
-    for chaincfg in chains:
-        print(chaincfg)
-        c = Chain(args.kver, chaincfg)
-        c.run(until = args.until)
+
+def do_run(args, conf, tracer=None):
+    # only needed to run chains, not for the other commands
+    from .signer import Signer
+    from .transaction import Transaction
+
+    jobs = get_jobs(args, conf)
+    history = get_history(args)
+    metrics = Metrics() if args.metrics else None
+    jobserver = get_jobserver(args)
+    signer = Signer(args.sign_jobs, jobserver) if args.sign_jobs > 0 else None
+    cache = None if args.no_cache else get_cache(args)
+
+    if args.install == "transaction":
+        transaction = Transaction(args.durability)
+    else:
+        transaction = None
+
+    install_failed = False
+
+    try:
+        failed = run_jobs(
+            jobs,
+            until = args.until,
+            workers = args.jobs,
+            link_jobs = args.link_jobs,
+            cache = cache,
+            durability = args.durability,
+            timeout = args.link_timeout,
+            logsize = args.log_size,
+            verbose = args.verbose,
+            jobserver = jobserver,
+            tracer = tracer,
+            metrics = metrics,
+            history = history,
+            schedule = args.schedule,
+            signer = signer,
+            transaction = transaction,
+        )
+
+        # what the chains that succeeded installed
+        if transaction:
+            with span(tracer, "ckis", "main", "commit", "phase") as spanargs:
+                spanargs["files"] = transaction.commit()
+    except InstallError as e:
+        print(f"ckis: {e}", file = sys.stderr)
+        install_failed = True
+    finally:
+        if signer:
+            signer.close()
+        if transaction:
+            transaction.close()
+
+    # once for the whole run, rather than on every store
+    if cache:
+        with span(tracer, "ckis", "main", "prune", "phase") as spanargs:
+            spanargs["evicted"] = cache.prune()
+
+    if history:
+        history.save()
+
+    if metrics:
+        metrics.write(args.metrics)
+
+    if tracer:
+        tracer.write(args.trace)
+
+    if failed:
+        print(
+            f"ckis: {len(failed)} of {len(jobs)} chain runs failed!",
+            file = sys.stderr
+        )
+        return 1
+
+    if install_failed:
+        return 1
+
+    return 0
+
+
+def get_config(args, cached=True):
+    if args.config:
+        data = args.config.read()
+    else:
+        with open(find_config(), "rb") as f:
+            data = f.read()
+
+    cachedir = args.cache_dir / "config" if cached else None
+
+    return load_sanitized_config(data, cachedir)
+
+
+def do_check(args):
+    failed = 0
+
+    for name, path in modules.get_module_index()["modules"].items():
+        try:
+            modules.get_module_info(name)
+        except (ValueError, TypeError, SyntaxError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            failed += 1
+
+    if failed:
+        print(f"ckis: {failed} modules are invalid!", file=sys.stderr)
+        return 1
+
+    conf = get_config(args, cached = False)
+    print(f"configuration ok, {len(conf["chains"])} chains")
+
+    return 0
 
 
 def fire():
     # don't write bytecode when importing modules (as we don't want
-    # __pycache__ directories cluttering /usr/lib/ckis)
+    # __pycache__ directories cluttering /usr/lib/ckis); modules are
+    # compiled into the cache directory instead
     sys.dont_write_bytecode = True
 
 
     args = handle_options()
 
-    if args.config:
-        tomlconf = tomllib.load(args.config)
-    else:
-        tomlconf = load_config()
-
-    conf = sanitize_config(tomlconf)
+    modules.cachedir = args.cache_dir / "modules"
 
     match args.cmd:
         case "run":
-            do_run(args, conf)
+            tracer = Tracer() if args.trace else None
+
+            with span(tracer, "ckis", "main", "config", "phase"):
+                conf = get_config(args)
+
+            return do_run(args, conf, tracer)
+
+        case "plan":
+            return do_plan(args, get_config(args))
+
+        case "cache":
+            return do_cache(args)
+
+        case "check":
+            return do_check(args)
+
+        case "compile-modules":
+            print(f"compiled {modules.compile_modules()} modules")
+            return 0
 
         case _:
             raise NotImplementedError()
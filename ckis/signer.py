@@ -0,0 +1,252 @@
+import base64
+import binascii
+import contextlib
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+from .cache import file_digest
+from .errors import ModuleError
+from .proc import RingLog, run_process
+from .util import transfer_file
+
+
+def signing_command(tool, key, cert, srcp, destp):
+    '''The command to sign the EFI image srcp with key and cert as destp.'''
+    match tool:
+        case "sbsign":
+            return [
+                "sbsign", "--key", key, "--cert", cert, "--output", destp,
+                srcp,
+            ]
+        case "uefisign":
+            return [ "uefisign", "-c", cert, "-k", key, "-o", destp, srcp ]
+        case _:
+            raise ModuleError(f"Unknown signing tool '{tool}'!")
+
+
+# fingerprints by path, with the mtime and size they were computed for
+fingerprints = {}
+fingerprints_lock = threading.Lock()
+
+
+def cert_fingerprint(path):
+    '''The SHA-256 fingerprint of the (PEM or DER) certificate at path.
+    Remembered as long as the file doesn't change, as every signing link
+    of every chain asks for it.
+    '''
+    st = os.stat(path)
+    version = (st.st_mtime_ns, st.st_size)
+
+    with fingerprints_lock:
+        if (cached := fingerprints.get(str(path), None)) and \
+                cached[0] == version:
+            return cached[1]
+
+    data = pathlib.Path(path).read_bytes()
+
+    # PEM files can have text around the certificate, like the subject and
+    # issuer openssl writes, and more than one certificate; the signing
+    # tools use the first
+    begin, end = b"-----BEGIN CERTIFICATE-----", b"-----END CERTIFICATE-----"
+    if (start := data.find(begin)) >= 0:
+        start += len(begin)
+        if (stop := data.find(end, start)) < 0:
+            raise ModuleError(f"{path}: the certificate has no end!")
+        try:
+            data = base64.b64decode(
+                b"".join(data[start:stop].split()), validate = True
+            )
+        except binascii.Error as e:
+            raise ModuleError(f"{path}: invalid certificate: {e}") from e
+
+    fingerprint = hashlib.sha256(data).hexdigest()
+
+    with fingerprints_lock:
+        fingerprints[str(path)] = (version, fingerprint)
+
+    return fingerprint
+
+
+class Signer:
+    '''Signs EFI images for all chains of a run, in the process that
+    started it. Chains in other processes send their requests over a unix
+    socket; copies of a Signer passed to them only act as a client.
+
+    Images with the same contents are signed only once with the same key
+    and certificate, e.g. the same kernel in several chains, and at most
+    workers signing commands run at the same time, no matter how many
+    chains and kernels are run at once. If there is a jobserver, the
+    commands also wait for their slot in it, like all others of the run.
+
+    The output and resource usage of every command are sent back to the
+    request that started it, so they end up with the link that asked.
+    '''
+
+    def __init__(self, workers=2, jobserver=None):
+        import concurrent.futures
+        import multiprocessing.connection
+
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="ckis-signer.")
+        self.address = os.path.join(self._tmpdir.name, "socket")
+        self.authkey = os.urandom(32)
+
+        self._listener = multiprocessing.connection.Listener(
+            self.address, "AF_UNIX", authkey=self.authkey
+        )
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self._jobserver = jobserver
+        self._results = {}
+        self._lock = threading.Lock()
+        self._closing = False
+
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+
+    def __getstate__(self):
+        return { "address": self.address, "authkey": self.authkey }
+
+    def __setstate__(self, state):
+        self.address = state["address"]
+        self.authkey = state["authkey"]
+        self._listener = None
+
+
+    def close(self):
+        if not self._listener:
+            return
+
+        import multiprocessing.connection
+
+        self._closing = True
+
+        # accept doesn't return when the listener is closed, so connect to
+        # wake it up
+        multiprocessing.connection.Client(
+            self.address, "AF_UNIX", authkey=self.authkey
+        ).close()
+        self._thread.join()
+
+        self._listener.close()
+        self._pool.shutdown()
+        self._tmpdir.cleanup()
+
+
+    ######## server ########
+
+    def _accept(self):
+        import multiprocessing
+
+        while True:
+            try:
+                conn = self._listener.accept()
+            except (OSError, multiprocessing.AuthenticationError):
+                continue
+
+            if self._closing:
+                conn.close()
+                return
+
+            threading.Thread(
+                target=self._serve, args=(conn,), daemon=True
+            ).start()
+
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                tool, key, cert, srcp, destp, cost = conn.recv()
+                signedp, log, usage = self._signed(
+                    tool, key, cert, srcp, cost
+                )
+                transfer_file(signedp, destp)
+            except Exception as e:
+                conn.send((str(e), None, None))
+            else:
+                conn.send((None, log, usage))
+
+
+    def _signed(self, tool, key, cert, srcp, cost={}):
+        '''Sign srcp, or wait until the same image is signed by another
+        request. Returns the path of the signed image, the output of the
+        signing command and its resource usage. Only the request that ran
+        the command gets the usage, so it is counted once.
+        '''
+        request = (tool, str(key), str(cert), file_digest(srcp))
+
+        with self._lock:
+            if ours := not (fut := self._results.get(request, None)):
+                n = len(self._results)
+                dest = pathlib.Path(self._tmpdir.name) / f"{n}.efi"
+                fut = self._pool.submit(
+                    self._run, tool, key, cert, srcp, dest, cost
+                )
+                self._results[request] = fut
+
+        signedp, log, usage = fut.result()
+
+        return signedp, log, usage if ours else None
+
+
+    def _run(self, tool, key, cert, srcp, destp, cost={}):
+        cmd = [ str(arg) for arg in
+                signing_command(tool, key, cert, srcp, destp) ]
+        log = RingLog()
+
+        if self._jobserver:
+            slot = self._jobserver.slot(cost)
+            cmd = self._jobserver.wrap(cmd)
+        else:
+            slot = contextlib.nullcontext()
+
+        import asyncio
+
+        with slot:
+            returncode, _, _, usage = asyncio.run(run_process(cmd, log))
+
+        if returncode != 0:
+            raise ModuleError(
+                f"'{tool}' failed with exit status {returncode}!"
+                f"\n{log.tail()}"
+            )
+
+        return destp, log.getvalue(), usage
+
+
+    ######## client ########
+
+    def sign(self, tool, key, cert, srcp, destp, cost={}, deadline=None,
+             cancel=None):
+        '''Sign srcp as destp through the signer, with a command that
+        takes cost (as in modcost) from the jobserver. Waits until it is
+        done, the monotonic clock passes deadline (TimeoutError) or cancel
+        is set (InterruptedError). Raises ModuleError if signing failed.
+
+        Returns the output of the signing command and its resource usage,
+        as returned by os.wait4. The usage is None if the image was signed
+        for another request.
+        '''
+        import multiprocessing.connection
+
+        with multiprocessing.connection.Client(
+            self.address, "AF_UNIX", authkey=self.authkey
+        ) as conn:
+            conn.send(
+                (tool, str(key), str(cert), str(srcp), str(destp), cost)
+            )
+
+            while not conn.poll(0.1):
+                if cancel and cancel.is_set():
+                    raise InterruptedError()
+                if deadline and time.monotonic() > deadline:
+                    raise TimeoutError()
+
+            error, log, usage = conn.recv()
+            if error:
+                raise ModuleError(error)
+
+            return log, usage
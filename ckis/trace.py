@@ -0,0 +1,114 @@
+import contextlib
+import json
+import threading
+import time
+import zlib
+
+
+class Tracer:
+    '''Records spans in the Chrome trace event format, which can be viewed
+    in Perfetto or chrome://tracing. Spans are grouped into tracks, one per
+    chain and kernel version, and threads within a track, e.g. one per
+    link.
+
+    A tracer can be passed to worker processes. The copy starts without
+    events; whatever the worker records is sent back and merged.
+    '''
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._named = set()
+
+        # timestamps are relative to the start of the run; the monotonic
+        # clock is the same in all processes, so worker events line up
+        self._start = time.monotonic_ns()
+
+
+    def __getstate__(self):
+        return { "_start": self._start }
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._start = state["_start"]
+
+
+    def _ids(self, track, thread):
+        # derived from the names, so all processes agree on them
+        pid = zlib.crc32(track.encode()) & 0x7fffffff
+        tid = zlib.crc32(thread.encode()) & 0x7fffffff
+
+        if (pid, tid) not in self._named:
+            self._named.add((pid, tid))
+            self.events += [
+                {
+                    "ph": "M", "name": "process_name", "pid": pid,
+                    "args": { "name": track },
+                },
+                {
+                    "ph": "M", "name": "thread_name", "pid": pid, "tid": tid,
+                    "args": { "name": thread },
+                },
+            ]
+
+        return pid, tid
+
+
+    @contextlib.contextmanager
+    def span(self, track, thread, name, cat="", **args):
+        '''Record the time spent in the with block as a span called name
+        on thread of track. Yields the arguments of the span, so more can
+        be added to them once they are known, e.g. the size of a file.
+        '''
+        start = time.monotonic_ns()
+
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = str(e) or type(e).__name__
+            raise
+        finally:
+            end = time.monotonic_ns()
+
+            with self._lock:
+                pid, tid = self._ids(track, thread)
+                self.events += [{
+                    "ph": "X",
+                    "name": name,
+                    "cat": cat,
+                    "ts": (start - self._start) / 1000,
+                    "dur": (end - start) / 1000,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                }]
+
+
+    def collected(self):
+        with self._lock:
+            return list(self.events)
+
+
+    def merge(self, events):
+        with self._lock:
+            self.events += events
+
+
+    def write(self, path):
+        with self._lock:
+            events = sorted(self.events, key=lambda e: e.get("ts", 0))
+
+        with open(path, "w") as f:
+            json.dump(
+                { "traceEvents": events, "displayTimeUnit": "ms" }, f
+            )
+
+
+def span(tracer, track, thread, name, cat="", **args):
+    '''Tracer.span if tracer is set. Otherwise nothing is recorded, at
+    the cost of a function call.
+    '''
+    if tracer is None:
+        return contextlib.nullcontext({})
+
+    return tracer.span(track, thread, name, cat, **args)
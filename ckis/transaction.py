@@ -0,0 +1,264 @@
+import os
+import pathlib
+import tempfile
+import threading
+
+from .errors import InstallError
+from .util import format_size, same_contents, syncfs, transfer_file
+
+
+# room left free on every filesystem, for its own metadata
+space_margin = 1024 * 1024 # 1 MiB
+
+
+def _format_owner(owner):
+    name, kver = owner
+    return f"chain {name} ({kver})"
+
+
+def _existing_parent(path):
+    while not path.exists():
+        path = path.parent
+
+    return path
+
+
+class Transaction:
+    '''The installs of all chains of a run. Chains stage the files they
+    install in a directory of the run, and commit writes all of them to
+    where they belong at the end of the run, in one pass: every file is
+    written under a temporary name next to its destination, each
+    filesystem is synced once, and then the files are renamed into place.
+    If anything fails, nothing is changed.
+
+    Like a Tracer, a Transaction can be passed to worker processes. They
+    stage into the same directory, but send what they staged back, so only
+    the parent commits.
+    '''
+
+    def __init__(self, durability="safe"):
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="ckis-install.")
+        self.stagedir = pathlib.Path(self._tmpdir.name)
+        self.durability = durability
+        self.entries = []
+        self._lock = threading.Lock()
+
+
+    def __getstate__(self):
+        return { "stagedir": self.stagedir, "durability": self.durability }
+
+    def __setstate__(self, state):
+        self._tmpdir = None
+        self.stagedir = state["stagedir"]
+        self.durability = state["durability"]
+        self.entries = []
+        self._lock = threading.Lock()
+
+
+    def close(self):
+        if self._tmpdir:
+            self._tmpdir.cleanup()
+
+
+    ######## staging ########
+
+    def stage(self, owner, srcp, destp):
+        '''Stage srcp to be installed as destp, for owner, the name and
+        kernel version of a chain. Returns the path of the staged file,
+        which has the name of destp, as later links of the chain read it
+        from there.
+        '''
+        staged = pathlib.Path(
+            tempfile.mkdtemp(prefix = f"{destp.name}.", dir = self.stagedir)
+        ) / destp.name
+
+        # the outputs of links are never changed, so they can be shared
+        transfer_file(srcp, staged, link=True)
+
+        with self._lock:
+            self.entries += [ (owner, str(staged), str(destp)) ]
+
+        return staged
+
+
+    def discard(self, owner):
+        '''Forget what owner staged, e.g. because its chain failed.'''
+        with self._lock:
+            dropped = [ e for e in self.entries if e[0] == owner ]
+            self.entries = [ e for e in self.entries if e[0] != owner ]
+
+        for _, staged, _ in dropped:
+            pathlib.Path(staged).unlink(missing_ok=True)
+
+
+    def collected(self):
+        with self._lock:
+            return list(self.entries)
+
+
+    def merge(self, entries):
+        with self._lock:
+            self.entries += entries
+
+
+    ######## committing ########
+
+    def plan(self):
+        '''What commit would do: the staged file to install as every
+        destination, as a dict. Files that would not change are left out.
+        Several chains may install the same file, as long as they all
+        install the same contents; otherwise, InstallError is raised, as
+        which of them ends up there would depend on which finished last.
+        '''
+        with self._lock:
+            entries = sorted(self.entries)
+
+        plan = {}
+        owners = {}
+
+        for owner, staged, destp in entries:
+            destp = pathlib.Path(destp)
+            staged = pathlib.Path(staged)
+
+            if destp not in plan:
+                plan[destp] = staged
+                owners[destp] = owner
+            elif not same_contents(plan[destp], staged):
+                raise InstallError(
+                    f"{destp} is installed with different contents by"
+                    f" {_format_owner(owners[destp])} and"
+                    f" {_format_owner(owner)}!"
+                )
+
+        return {
+            destp: staged for destp, staged in plan.items()
+            if not same_contents(staged, destp)
+        }
+
+
+    def check_space(self, plan):
+        '''Raise InstallError if a filesystem has no room for the files of
+        plan that go to it. Old files are only removed once all new ones are
+        written, so their space doesn't count. Returns a path on every
+        filesystem that is written to.
+        '''
+        filesystems = {}
+        needed = {}
+
+        for destp, staged in plan.items():
+            parent = _existing_parent(destp.parent)
+            dev = os.stat(parent).st_dev
+
+            if dev not in filesystems:
+                filesystems[dev] = (parent, os.statvfs(parent))
+
+            # whole blocks are allocated
+            bsize = filesystems[dev][1].f_frsize
+            size = -(-staged.stat().st_size // bsize) * bsize
+            needed[dev] = needed.get(dev, 0) + size
+
+        for dev, (path, st) in filesystems.items():
+            free = st.f_bavail * st.f_frsize
+
+            if needed[dev] + space_margin > free:
+                raise InstallError(
+                    f"Not enough space on the filesystem of {path}:"
+                    f" {format_size(needed[dev])} needed,"
+                    f" {format_size(free)} free!"
+                )
+
+        return [ path for path, _ in filesystems.values() ]
+
+
+    def commit(self):
+        '''Install everything that was staged. Returns the number of files
+        that were written. Raises InstallError if there is not enough space
+        or writing fails; in that case, all destinations are left as they
+        were.
+        '''
+        plan = self.plan()
+
+        if not plan:
+            return 0
+
+        filesystems = self.check_space(plan)
+        safe = self.durability == "safe"
+
+        temps = {}
+        backups = {}
+
+        try:
+            for destp, staged in plan.items():
+                destp.parent.mkdir(parents=True, exist_ok=True)
+
+                fd, tmpp = tempfile.mkstemp(
+                    prefix = f".{destp.name}.", suffix = ".tmp",
+                    dir = destp.parent
+                )
+                os.close(fd)
+
+                temps[destp] = pathlib.Path(tmpp)
+                transfer_file(staged, tmpp)
+
+            # one sync per filesystem, instead of one per file
+            if safe:
+                for path in filesystems:
+                    syncfs(path)
+
+            for destp, tmpp in temps.items():
+                backups[destp] = self._backup(destp)
+                os.rename(tmpp, destp)
+        except BaseException as e:
+            self._rollback(temps, backups)
+
+            if isinstance(e, OSError):
+                raise InstallError(
+                    f"Installing failed, nothing was changed: {e}"
+                ) from e
+            raise
+
+        # make the renames durable
+        if safe:
+            for path in filesystems:
+                syncfs(path)
+
+        for backup in backups.values():
+            if backup:
+                backup.unlink(missing_ok=True)
+
+        return len(plan)
+
+
+    def _backup(self, destp):
+        '''Keep the file at destp, if any, to restore it on rollback.
+        Returns the path of the backup, or None if there is no file.
+        '''
+        if not os.path.lexists(destp):
+            return None
+
+        backup = destp.with_name(f".{destp.name}.old")
+        backup.unlink(missing_ok=True)
+
+        try:
+            os.link(destp, backup)
+        except OSError:
+            # no hardlinks, e.g. on vfat; move the old file away instead,
+            # it is replaced right after
+            os.rename(destp, backup)
+
+        return backup
+
+
+    def _rollback(self, temps, backups):
+        # best effort; anything left over is at least not in the way
+        for destp, backup in backups.items():
+            try:
+                if backup:
+                    os.replace(backup, destp)
+                else:
+                    destp.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+        for tmpp in temps.values():
+            tmpp.unlink(missing_ok=True)
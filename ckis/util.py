@@ -1,6 +1,12 @@
 import csv
+import errno
+import fcntl
+import functools
+import hashlib
 import os
 import pathlib
+import shutil
+import struct
 
 def to_path(cwd, path):
     '''Convert a string or Path object to a path. If it is a relative path,
@@ -36,6 +42,18 @@ def filter_class(iterable, baseclass):
     return list(l)
 
 
+# These describe the host and not a kernel, so they only need to be looked up
+# once per ckis invocation, no matter how many chains and kernels are run.
+
+@functools.cache
+def get_osrelease():
+    import platform
+
+    # only works if /etc/os-release or /usr/lib/os-release is present
+    return platform.freedesktop_os_release()
+
+
+@functools.cache
 def search_esp_paths():
     # common locations for esp in order of likeliness.
     # it is still recommended to set it manually in config.toml
@@ -46,3 +64,228 @@ def search_esp_paths():
 
     # if none of these match, give up
     return None
+
+
+def find_kernels(moddir="/usr/lib/modules"):
+    '''Find the versions of all installed kernels, i.e. all kernels that
+    are installed as /usr/lib/modules/$kver/boot/vmlinuz-$kver.
+    '''
+    kvers = []
+
+    for kernel in pathlib.Path(moddir).glob("*/boot/vmlinuz-*"):
+        kver = kernel.parent.parent.name
+        if kernel.name == f"vmlinuz-{kver}":
+            kvers += [ kver ]
+
+    return sorted(kvers)
+
+
+size_units = [ "K", "M", "G", "T" ]
+
+def parse_size(val):
+    '''Parse a size like 512M or 2G into bytes.'''
+    val = val.strip().upper().removesuffix("B").removesuffix("I")
+
+    mult = 1
+    if val and val[-1] in size_units:
+        mult = 1024 ** (size_units.index(val[-1]) + 1)
+        val = val[:-1]
+
+    try:
+        return int(float(val) * mult)
+    except ValueError:
+        raise ValueError(f"Invalid size: '{val}'")
+
+
+def format_size(size):
+    unit = ""
+    for u in size_units:
+        if size < 1024:
+            break
+        size /= 1024
+        unit = u
+
+    return f"{size:.1f}{unit}" if unit else f"{size}"
+
+
+def same_contents(a, b):
+    '''Whether files a and b exist and have the same contents. Sizes are
+    compared first, so the files are only read if they might be the same.
+    '''
+    try:
+        if os.stat(a).st_size != os.stat(b).st_size:
+            return False
+
+        with open(a, "rb") as fa, open(b, "rb") as fb:
+            return (hashlib.file_digest(fa, "sha256").digest()
+                == hashlib.file_digest(fb, "sha256").digest())
+    except FileNotFoundError:
+        return False
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@functools.cache
+def _libc():
+    import ctypes
+    return ctypes.CDLL(None, use_errno=True)
+
+
+def syncfs(path):
+    '''Write everything cached for the filesystem that path is on to disk,
+    and nothing else. Syncs all filesystems if syncfs is not available.
+    '''
+    import ctypes
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc().syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+    except AttributeError:
+        os.sync()
+    finally:
+        os.close(fd)
+
+
+# from linux/fs.h
+FICLONE = 0x40049409
+FICLONERANGE = 0x4020940d
+file_clone_range = struct.Struct("=qQQQ")
+
+
+def _copy_range(src, dest):
+    '''Copy the contents of file object src to dest, letting the kernel do
+    the work where it can. Returns the method that was used.
+    '''
+    size = os.fstat(src.fileno()).st_size
+
+    for method, func in [
+        ("copy_file_range", os.copy_file_range),
+        ("sendfile", lambda s, d, n: os.sendfile(d, s, None, n)),
+    ]:
+        src.seek(0)
+        dest.seek(0)
+        dest.truncate()
+
+        try:
+            while func(src.fileno(), dest.fileno(), 1 << 30) > 0:
+                pass
+        except OSError as e:
+            # e.g. different filesystems, or not supported for these files;
+            # try the next method
+            if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.EBADF):
+                continue
+            raise
+
+        if os.fstat(dest.fileno()).st_size == size:
+            return method
+
+    src.seek(0)
+    dest.seek(0)
+    dest.truncate()
+    shutil.copyfileobj(src, dest)
+
+    return "copy"
+
+
+def transfer_file(srcp, destp, link=False):
+    '''Copy the file srcp to destp, including its metadata, in the cheapest
+    way possible. In order of preference: a reflink (on e.g. btrfs or xfs),
+    a hardlink (if link=True; only when neither file is ever changed
+    afterwards), copy_file_range, sendfile or a plain copy. destp is
+    overwritten if it exists.
+
+    Returns the method that was used.
+    '''
+    if link:
+        try:
+            os.unlink(destp)
+        except FileNotFoundError:
+            pass
+
+        try:
+            os.link(srcp, destp)
+            return "hardlink"
+        except OSError:
+            # not on the same filesystem or not supported by it
+            pass
+
+    with open(srcp, "rb") as src, open(destp, "wb") as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            method = "reflink"
+        except OSError:
+            method = _copy_range(src, dest)
+
+    shutil.copystat(srcp, destp)
+
+    return method
+
+
+def _append_range(src, dest, offset, size):
+    '''Copy the contents of file object src to dest at offset. Returns the
+    method that was used.
+    '''
+    try:
+        done = 0
+        while done < size:
+            n = os.copy_file_range(
+                src.fileno(), dest.fileno(), size - done, done, offset + done
+            )
+            if n == 0:
+                break
+            done += n
+
+        if done == size:
+            return "copy_file_range"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.EBADF):
+            raise
+
+    src.seek(0)
+    dest.seek(offset)
+    shutil.copyfileobj(src, dest)
+
+    return "copy"
+
+
+def concat_files(srcs, destp):
+    '''Write the contents of the files srcs one after the other to destp.
+    Where the filesystem supports it, every file is cloned by reflink, so
+    destp shares its blocks with srcs; this needs every file but the last
+    to be a multiple of the block size of the filesystem long. The others
+    are copied.
+
+    Returns the methods that were used, one per file.
+    '''
+    methods = []
+
+    with open(destp, "wb") as dest:
+        offset = 0
+
+        for srcp in srcs:
+            with open(srcp, "rb") as src:
+                size = os.fstat(src.fileno()).st_size
+
+                try:
+                    fcntl.ioctl(dest.fileno(), FICLONERANGE,
+                                file_clone_range.pack(
+                                    src.fileno(), 0, size, offset
+                                ))
+                    methods += [ "reflink" ]
+                except OSError:
+                    # not supported, different filesystems or unaligned
+                    methods += [ _append_range(src, dest, offset, size) ]
+
+            offset += size
+
+    return methods
@@ -1,7 +1,14 @@
 modname = "initrd/booster"
 
 modoptions = { "BoosterConfFile": "file" }
+modcost = { "cpus": 2, "memory": "512M" }
 optconfig = { "BoosterConfFile" }
+outputs = { "initrd" }
+
+# what ends up in the initrd depends on the whole host (userspace, udev
+# rules, loaded modules, ...), so there is no telling when a cached one
+# is stale
+cacheable = False
 
 def fire(self):
     initrd = self.Initrd("initrd.img")
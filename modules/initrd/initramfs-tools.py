@@ -1,4 +1,11 @@
 modname = "initrd/initramfs-tools"
+modcost = { "cpus": 1, "memory": "256M" }
+outputs = { "initrd" }
+
+# what ends up in the initrd depends on the whole host (userspace, udev
+# rules, loaded modules, ...), so there is no telling when a cached one
+# is stale
+cacheable = False
 
 def fire(self):
     initrd = self.Initrd(self.cwd / "initrd.img")   
@@ -0,0 +1,229 @@
+modname = "initrd/native"
+moddesc = """
+Initrd built without external tools
+
+Writes the files declared in InitrdFiles (in the format of the kernel's
+gen_init_cpio, plus 'tree <name> <location>' for whole directories) into a
+newc cpio archive. It is compressed in independent blocks on all cores,
+straight from the files, without a staging tree.
+
+'layer <name> [<compression>]' lines split the initrd into layers, which
+are cached on their own and concatenated into the initrd, e.g. so that
+firmware and userspace are shared by all kernel versions and a new kernel
+only needs its modules packed. If InitrdMicrocode is set to a firmware
+directory, the CPU microcode in it (decompressed, if the distribution
+compresses its firmware) is put into an uncompressed layer in front, for
+the kernel to load early. Kernel modules from a kmods input,
+e.g. of kmods/hostonly, go into a layer of their own at the end.
+"""
+
+modoptions = {
+    "InitrdFiles": "file",
+    "InitrdCompression": "str",
+    "InitrdMicrocode": "dir",
+}
+config = { "InitrdFiles" }
+optconfig = { "InitrdCompression", "InitrdMicrocode" }
+optinputs = { "kmods" }
+outputs = { "initrd" }
+
+
+import fnmatch as _fnmatch
+import lzma as _lzma
+import os as _os
+import pathlib as _pathlib
+import stat as _stat
+
+from ckis.cache import file_digest as _file_digest, make_key as _make_key
+from ckis.errors import ModuleError as _ModuleError
+from ckis.util import concat_files as _concat_files
+import ckis.cpio as _cpio
+import ckis.kmod as _kmod
+
+# where the kernel looks for early microcode, and where distributions
+# install it in the firmware directory, with the names of the files
+# (family-model-stepping for Intel, one file per family for AMD)
+_microcode = {
+    "GenuineIntel.bin": ("intel-ucode", "??-??-??"),
+    "AuthenticAMD.bin": ("amd-ucode", "microcode_amd*.bin"),
+}
+_microcode_dir = "kernel/x86/microcode"
+
+
+def _unzstd(data):
+    # in the standard library from Python 3.14 on
+    try:
+        from compression import zstd
+        return zstd.decompress(data)
+    except ImportError:
+        pass
+
+    try:
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(data).read()
+    except ImportError:
+        raise _ModuleError(
+            "zstd compressed microcode needs Python 3.14 or zstandard!"
+        )
+
+
+# some distributions compress their firmware; the kernel only takes raw
+# microcode
+_decompressors = { ".xz": _lzma.decompress, ".zst": _unzstd }
+
+
+def _file_list(self):
+    with open(self.config["InitrdFiles"]) as f:
+        return f.read()
+
+
+def _microcode_files(self):
+    '''The microcode files to put into the initrd, by the name the kernel
+    looks for.
+    '''
+    if not (firmware := self.config.get("InitrdMicrocode", None)):
+        return {}
+
+    files = {}
+
+    for name, (subdir, pattern) in _microcode.items():
+        if not (firmware / subdir).is_dir():
+            continue
+
+        # by the name of the raw file, which wins over a compressed one
+        srcs = {}
+
+        for p in (firmware / subdir).iterdir():
+            if not p.is_file():
+                continue
+
+            if _fnmatch.fnmatchcase(p.name, pattern):
+                srcs[p.name] = p
+            elif p.suffix in _decompressors and \
+                    _fnmatch.fnmatchcase(p.stem, pattern):
+                srcs.setdefault(p.stem, p)
+
+        if srcs:
+            files[name] = [ srcs[raw] for raw in sorted(srcs) ]
+
+    return files
+
+
+def _read_microcode(path):
+    try:
+        data = path.read_bytes()
+    except OSError as e:
+        raise _ModuleError(f"Cannot read microcode {path}: {e}")
+
+    if decompress := _decompressors.get(path.suffix, None):
+        try:
+            data = decompress(data)
+        except _ModuleError:
+            raise
+        except Exception as e:
+            raise _ModuleError(f"Cannot decompress microcode {path}: {e}")
+
+    return data
+
+
+def _kmods_layers(self):
+    if not (kmods := self.inputs.get("kmods", None)):
+        return []
+
+    entries = _kmod.initrd_entries(
+        _pathlib.Path(kmods.root), self.kver,
+        kmods.path.read_text().splitlines()
+    )
+
+    return [ ("kmods", None, entries) ]
+
+
+def _microcode_key(files):
+    key = {}
+
+    for name, srcs in files.items():
+        key[name] = []
+
+        for p in srcs:
+            try:
+                st = _os.stat(p)
+            except OSError as e:
+                raise _ModuleError(f"Cannot read microcode {p}: {e}")
+
+            key[name] += [ (str(p), st.st_size, st.st_mtime_ns) ]
+
+    return key
+
+
+def _write_layer(self, entries, destp, compression):
+    # compressed on as many cores as the jobserver grants
+    with self.cpu_slot() as cpus:
+        _cpio.write_initrd(
+            entries, destp, compression, workers = cpus,
+            alignment = _cpio.layer_alignment,
+            initializer = self.lower_priority,
+        )
+
+
+def _build_microcode(self, files, destp):
+    entries = [
+        (path, _stat.S_IFDIR | 0o755, 0, 0, None, None, 0)
+        for path in [ "kernel", "kernel/x86", _microcode_dir ]
+    ]
+
+    # the kernel takes one file per vendor, with all their microcode
+    for name, srcs in files.items():
+        blob = self.cwd / name
+        with open(blob, "wb") as f:
+            for src in srcs:
+                f.write(_read_microcode(src))
+        entries += [(
+            f"{_microcode_dir}/{name}", _stat.S_IFREG | 0o644, 0, 0,
+            blob, None, 0
+        )]
+
+    _write_layer(self, entries, destp, "none")
+
+
+def cachekey(self):
+    # the listed files can change without the list changing; their size
+    # and mtime are cheap to check, unlike their contents
+    return [
+        _cpio.entries_key(_cpio.parse_file_list(_file_list(self), self.kver)),
+        _microcode_key(_microcode_files(self)),
+        [ _cpio.entries_key(layer[2]) for layer in _kmods_layers(self) ],
+    ]
+
+
+def fire(self):
+    compression = self.config.get("InitrdCompression", "gzip")
+
+    # layers are cached by their contents and how they are written, not by
+    # the kernel they are for
+    version = _file_digest(_cpio.__file__)
+    layers = []
+
+    if files := _microcode_files(self):
+        layers += [ self.cached_file(
+            "microcode.cpio",
+            _make_key("initrd-layer", version, _microcode_key(files)),
+            lambda destp: _build_microcode(self, files, destp),
+        ) ]
+
+    for i, (name, comp, entries) in enumerate(
+        _cpio.parse_layers(_file_list(self), self.kver) + _kmods_layers(self)
+    ):
+        comp = comp or compression
+
+        layers += [ self.cached_file(
+            f"layer-{i}-{name}.cpio",
+            _make_key(
+                "initrd-layer", version, comp, _cpio.entries_key(entries)
+            ),
+            lambda destp: _write_layer(self, entries, destp, comp),
+        ) ]
+
+    initrd = self.Initrd("initrd.img")
+    _concat_files(layers, initrd.path)
+
+    return initrd
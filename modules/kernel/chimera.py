@@ -1,10 +1,12 @@
 modname = "kernel/chimera"
+outputs = { "config", "kernel" }
 
 def fire(self):
     cpath = f"/usr/lib/modules/{self.kver}/boot/config-{self.kver}"
     kpath = f"/usr/lib/modules/{self.kver}/boot/vmlinuz-{self.kver}"
 
-    self.cp(cpath, "config")
-    self.cp(kpath, "kernel")
-
-    return [ self.Config("config"), self.Kernel("kernel") ]
+    # no need to copy these, later links read them from where they are
+    return [
+        self.Config(cpath, readonly=True),
+        self.Kernel(kpath, readonly=True),
+    ]
@@ -0,0 +1,72 @@
+modname = "kmods/hostonly"
+moddesc = """
+Kernel modules needed by the devices of this host
+
+Matches the modaliases of all devices in sysfs against the modules.alias of
+the kernel, and adds what the matching modules depend on from modules.dep
+and modules.softdep.
+The result is the list of modules for initrd links that take kmods, instead
+of every module of the kernel. HostonlyModules adds modules that no device
+asks for, e.g. those of the root filesystem.
+
+The parsed module index of every kernel version is cached.
+"""
+
+modoptions = {
+    "HostonlySysfs": "dir",
+    "HostonlyModuleDir": "dir",
+    "HostonlyModules": "str",
+}
+optconfig = { "HostonlySysfs", "HostonlyModuleDir", "HostonlyModules" }
+outputs = { "kmods" }
+
+
+from ckis.cache import make_key as _make_key
+import ckis.kmod as _kmod
+
+# indexes loaded by this process, by their cache key
+_indexes = {}
+
+
+def _moddir(self):
+    root = self.config.get("HostonlyModuleDir", _kmod.default_moddir)
+    return root / self.kver
+
+
+def _aliases(self):
+    return _kmod.host_aliases(
+        self.config.get("HostonlySysfs", _kmod.default_sysfs)
+    )
+
+
+def _index(self):
+    moddir = _moddir(self)
+    key = _make_key("kmod-index", _kmod.index_key(moddir))
+
+    if (index := _indexes.get(key, None)) is None:
+        path = self.cached_file(
+            "modules.index", key,
+            lambda destp: _kmod.write_index(_kmod.build_index(moddir), destp)
+        )
+        index = _indexes[key] = _kmod.read_index(path)
+
+    return index
+
+
+def cachekey(self):
+    # devices come and go, and the modules of a kernel can be rebuilt
+    return [ sorted(_aliases(self)), _kmod.index_key(_moddir(self)) ]
+
+
+def fire(self):
+    index = _index(self)
+
+    names = _kmod.match_aliases(index, _aliases(self))
+    names |= set(self.config.get("HostonlyModules", "").split())
+
+    kmods = self.Kmods("modules.list", root=_moddir(self))
+    kmods.path.write_text(
+        "".join(f"{path}\n" for path in _kmod.resolve(index, names))
+    )
+
+    return kmods
@@ -8,6 +8,8 @@ these uki's (e.g. systemd-boot).
 """
 
 inputs =  { "uki" }
+outputs = { "uki" }
+installs = True
 
 
 def fire(self):
@@ -17,7 +19,7 @@ def fire(self):
         f"{self.osrelease['ID']}-{self.name}-{self.kver}.efi")
 
     self.mkdir(self.esp / "EFI/Linux", parents=True)
-    self.cp(self.inputs["uki"].path, uki.path)
+    self.install(self.inputs["uki"].path, uki.path)
 
     uki.installed = True
 
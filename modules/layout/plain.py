@@ -2,6 +2,8 @@ modname = "layout/plain"
 moddesc = "Install seperate kernel files in /boot"
 inputs = { "kernel" }
 optinputs = {"initrd", "config", "symbols"}
+outputs = { "kernel", "initrd", "config", "symbols" }
+installs = True
 
 def fire(self):
     outputs = {
@@ -18,7 +20,7 @@ def fire(self):
             out = self.copy(self.inputs[f])
             out.path = self.boot / outputs[f]
 
-            self.cp(self.inputs[f].path, out.path )
+            self.install(self.inputs[f].path, out.path)
 
             out.installed = True
 
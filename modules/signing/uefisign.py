@@ -3,6 +3,7 @@ moddesc = "sign an EFI executable with uefisign"
 
 inputs = { "signable" } # something we can sign (kernel or uki)
 config = { "sbkey", "sbcert" }
+outputs = { "signable" }
 
 
 def fire(self):
@@ -12,13 +13,7 @@ def fire(self):
     image = self.copy(self.inputs["signable"])
     image.path = "signed.efi"
 
-    cmd = [ "uefisign" ]
-    cmd += [ "-c", self.config["sbcert"] ]
-    cmd += [ "-k", self.config["sbkey"] ]
-    cmd += [ "-o", image.path ]
-    cmd += [ self.inputs["signable"].path ]
-    
-    self.do(cmd)
+    self.sign(self.inputs["signable"].path, image.path, tool = "uefisign")
 
     image.signed = True
 
@@ -0,0 +1,122 @@
+modname = "uki/native"
+moddesc = """
+Unified kernel image, built without external tools
+
+Appends the kernel, initrd, kernel command line, os-release and an optional
+splash image as sections to the systemd EFI stub. Input files are written
+into the image directly, so building it costs about one write of the image.
+"""
+
+modoptions = {
+    "UkiStub": "file",
+    "UkiCmdline": "str",
+    "UkiSplash": "file",
+}
+optconfig = { "UkiStub", "UkiCmdline", "UkiSplash" }
+inputs = { "kernel" }
+optinputs = { "initrd" }
+outputs = { "uki" }
+
+
+import os as _os
+import platform as _platform
+
+from ckis.cache import file_digest as _file_digest
+from ckis.errors import ModuleError as _ModuleError
+from ckis.pe import add_sections as _add_sections
+
+# the names systemd uses for the stubs of every architecture
+_efi_arch = {
+    "x86_64": "x64",
+    "i686": "ia32",
+    "aarch64": "aa64",
+    "riscv64": "riscv64",
+    "loongarch64": "loongarch64",
+}
+
+# where the command line is taken from if UkiCmdline is not set, like
+# kernel-install does
+_cmdline_files = [ "/etc/kernel/cmdline", "/proc/cmdline" ]
+
+# set by the boot loader for the running kernel; kernel-install drops them
+# from /proc/cmdline as well
+_bootloader_params = ( "BOOT_IMAGE=", "initrd=" )
+
+
+def _stub(self):
+    if stub := self.config.get("UkiStub", None):
+        return stub
+
+    arch = _efi_arch.get(_platform.machine(), _platform.machine())
+    return f"/usr/lib/systemd/boot/efi/linux{arch}.efi.stub"
+
+
+def _cmdline(self):
+    if (cmdline := self.config.get("UkiCmdline", None)) is None:
+        for path in _cmdline_files:
+            if _os.path.exists(path):
+                with open(path) as f:
+                    words = f.read().split()
+                if path == "/proc/cmdline":
+                    words = [
+                        word for word in words
+                        if not word.startswith(_bootloader_params)
+                    ]
+                cmdline = " ".join(words)
+                break
+        else:
+            cmdline = ""
+
+    # the stub passes it to the kernel as a C string
+    return cmdline.encode() + b"\0"
+
+
+def _osrel(self):
+    def quote(val):
+        for c in "\\\"$`":
+            val = val.replace(c, "\\" + c)
+        return f'"{val}"'
+
+    return "".join(
+        f"{key}={quote(val)}\n" for key, val in self.osrelease.items()
+    ).encode()
+
+
+def cachekey(self):
+    # the stub and command line can change without the config changing
+    stub = _stub(self)
+
+    return [
+        _file_digest(stub) if _os.path.isfile(stub) else None,
+        _cmdline(self).decode(),
+        _osrel(self).decode(),
+    ]
+
+
+def fire(self):
+    stub = _stub(self)
+
+    if not _os.path.isfile(stub):
+        raise _ModuleError(
+            f"EFI stub {stub} not found; install it or set UkiStub!"
+        )
+
+    sections = [
+        (".osrel", _osrel(self)),
+        (".cmdline", _cmdline(self)),
+        (".uname", self.kver.encode()),
+    ]
+
+    if splash := self.config.get("UkiSplash", None):
+        sections += [ (".splash", splash) ]
+
+    if initrd := self.inputs.get("initrd", None):
+        sections += [ (".initrd", initrd.path) ]
+
+    # in the same order as ukify
+    sections += [ (".linux", self.inputs["kernel"].path) ]
+
+    uki = self.Uki(f"linux-{self.kver}.efi")
+    _add_sections(stub, sections, uki.path)
+
+    return uki
@@ -0,0 +1,175 @@
+import gzip
+import lzma
+import os
+import pathlib
+import stat
+import tempfile
+import unittest
+
+from ckis import cpio
+from ckis.errors import ModuleError
+
+
+def read_cpio(data):
+    '''The entries of the concatenated newc archives in data, as a dict of
+    (mode, contents, rdev) by name, with the zeros between archives
+    skipped like the kernel does.
+    '''
+    entries = {}
+    pos = 0
+
+    while pos < len(data):
+        if data[pos:pos + 4] == b"\0\0\0\0":
+            pos += 4
+            continue
+
+        assert data[pos:pos + 6] == b"070701", data[pos:pos + 6]
+        fields = [
+            int(data[pos + 6 + 8 * i:pos + 14 + 8 * i], 16)
+            for i in range(13)
+        ]
+        mode, size = fields[1], fields[6]
+        rdev = os.makedev(fields[9], fields[10])
+        namesize = fields[11]
+
+        pos += 110
+        name = data[pos:pos + namesize - 1].decode()
+        pos += namesize
+        pos += -pos % 4
+
+        contents = data[pos:pos + size]
+        pos += size
+        pos += -pos % 4
+
+        if name != "TRAILER!!!":
+            entries[name] = (mode, contents, rdev)
+
+    return entries
+
+
+class CpioTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = pathlib.Path(tmpdir.name)
+
+        self.tree = self.root / "tree"
+        (self.tree / "etc").mkdir(parents=True)
+        (self.tree / "etc" / "hostname").write_text("host\n")
+        (self.tree / "init").write_bytes(b"\x7fELF" + bytes(range(256)) * 9)
+        (self.tree / "bin").symlink_to("usr/bin")
+
+        self.outp = self.root / "initrd.img"
+
+
+    def file_list(self):
+        return f"""
+            # comment
+            dir /dev 0755 0 0
+            nod /dev/console 0600 0 0 c 5 1
+            slink /lib64 lib 0777 0 0
+            file /lib/modules/${{kver}}/modules.dep {self.tree}/etc/hostname \
+                0644 0 0
+            tree /root {self.tree}
+        """
+
+
+    def test_parse_file_list(self):
+        entries = list(cpio.parse_file_list(self.file_list(), "6.1.0"))
+        names = [ entry[0] for entry in entries ]
+
+        self.assertEqual(names[:4], [
+            "/dev", "/dev/console", "/lib64",
+            "/lib/modules/6.1.0/modules.dep",
+        ])
+        self.assertEqual(entries[1][6], os.makedev(5, 1))
+        self.assertIn("/root/bin", names)
+        self.assertIn("/root/etc/hostname", names)
+
+        with self.assertRaises(ModuleError):
+            list(cpio.parse_file_list("file /x\n", "6.1.0"))
+
+
+    def test_parse_layers(self):
+        layers = cpio.parse_layers(
+            "dir /a 0755 0 0\n"
+            "layer firmware none\n"
+            "dir /b 0755 0 0\n"
+            "layer empty\n",
+            "6.1.0"
+        )
+
+        self.assertEqual(
+            [ (name, compression) for name, compression, _ in layers ],
+            [ ("main", None), ("firmware", "none") ]
+        )
+
+
+    def roundtrip(self, compression, decompress, **kwargs):
+        entries = list(cpio.parse_file_list(self.file_list(), "6.1.0"))
+        nblocks = cpio.write_initrd(
+            entries, self.outp, compression, **kwargs
+        )
+        files = read_cpio(decompress(self.outp.read_bytes()))
+
+        self.assertEqual(
+            sorted(files), sorted(entry[0].lstrip("/") for entry in entries)
+        )
+        self.assertEqual(
+            files["root/init"][1], (self.tree / "init").read_bytes()
+        )
+        self.assertEqual(files["lib/modules/6.1.0/modules.dep"][1], b"host\n")
+        self.assertEqual(files["lib64"][1], b"lib")
+        self.assertEqual(files["root/bin"][1], b"usr/bin")
+        self.assertTrue(stat.S_ISLNK(files["root/bin"][0]))
+        self.assertTrue(stat.S_ISDIR(files["dev"][0]))
+        self.assertEqual(files["dev/console"][2], os.makedev(5, 1))
+
+        return nblocks
+
+
+    def test_roundtrip(self):
+        for compression, decompress in [
+            ("none", lambda data: data),
+            ("gzip", gzip.decompress),
+            ("xz", lzma.decompress),
+        ]:
+            with self.subTest(compression = compression):
+                self.assertEqual(self.roundtrip(compression, decompress), 1)
+
+
+    def test_blocks(self):
+        # every block is an archive of its own, compressed on its own
+        nblocks = self.roundtrip(
+            "gzip", gzip.decompress, blocksize = 1024, workers = 2
+        )
+        self.assertGreater(nblocks, 1)
+
+
+    def test_alignment(self):
+        self.roundtrip("none", lambda data: data, alignment = 4096)
+        self.assertEqual(self.outp.stat().st_size % 4096, 0)
+
+
+    def test_reproducible(self):
+        entries = list(cpio.parse_file_list(self.file_list(), "6.1.0"))
+
+        cpio.write_initrd(entries, self.outp)
+        first = self.outp.read_bytes()
+        key = cpio.entries_key(entries)
+
+        # mtimes don't end up in the initrd, but are part of the key
+        os.utime(self.tree / "init", (0, 0))
+        cpio.write_initrd(entries, self.outp)
+
+        self.assertEqual(self.outp.read_bytes(), first)
+        self.assertNotEqual(cpio.entries_key(entries), key)
+
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ModuleError):
+            cpio.write_initrd([], self.outp, "lz4")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+import pathlib
+import tempfile
+import unittest
+
+from ckis import kmod
+from ckis.errors import ModuleError
+
+
+modules_dep = """\
+kernel/drivers/net/e1000e.ko.zst: kernel/net/core/ptp-core.ko.zst
+kernel/net/core/ptp-core.ko.zst:
+kernel/drivers/usb/usb-storage.ko.zst: kernel/drivers/scsi/scsi_mod.ko.zst
+kernel/drivers/scsi/scsi_mod.ko.zst:
+kernel/fs/btrfs/btrfs.ko.zst: kernel/lib/raid6/raid6_pq.ko.zst
+kernel/lib/raid6/raid6_pq.ko.zst:
+kernel/crypto/crc32c-generic.ko.zst:
+kernel/sound/pci/hda/snd-hda-intel.ko.zst:
+"""
+
+modules_alias = """\
+# Aliases extracted from modules themselves.
+alias pci:v00008086d000015B8sv*sd*bc*sc*i* e1000e
+alias pci:v00008086d*sv*sd*bc04sc03i* snd_hda_intel
+alias usb:v*p*d*dc*dsc*dp*ic08isc06ip50in* usb_storage
+alias fs-btrfs btrfs
+alias pci:v0000BEEFd*sv*sd*bc*sc*i* missing_driver
+"""
+
+modules_builtin = """\
+kernel/drivers/ata/ahci.ko
+kernel/fs/ext4/ext4.ko
+"""
+
+modules_softdep = """\
+# Soft dependencies extracted from modules themselves.
+softdep btrfs pre: crc32c-generic not-there
+softdep usb_storage post: uas
+softdep e1000e pre: ptp-core
+"""
+
+host_devices = {
+    "pci0000:00/0000:00:19.0":
+        "pci:v00008086d000015B8sv000017AAsd00002247bc02sc00i00",
+    "pci0000:00/0000:00:1f.3":
+        "pci:v00008086d00009D71sv000017AAsd00002247bc04sc03i00",
+    "pci0000:00/0000:00:14.0/usb1/1-1/1-1:1.0":
+        "usb:v0781p5581d0100dc00dsc00dp00ic08isc06ip50in00",
+    # devices without a driver have empty modaliases
+    "platform/serial8250": "",
+}
+
+
+class KmodTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = pathlib.Path(tmpdir.name)
+
+        self.moddir = self.root / "modules" / "6.1.0"
+        self.moddir.mkdir(parents=True)
+        for name, text in [
+            ("modules.dep", modules_dep),
+            ("modules.alias", modules_alias),
+            ("modules.builtin", modules_builtin),
+            ("modules.softdep", modules_softdep),
+        ]:
+            (self.moddir / name).write_text(text)
+
+        self.sysfs = self.root / "sys"
+        for dev, alias in host_devices.items():
+            path = self.sysfs / "devices" / dev
+            path.mkdir(parents=True)
+            (path / "modalias").write_text(alias + "\n")
+
+
+    def index(self):
+        # what kmods/hostonly uses, after a round trip through the cache
+        path = self.root / "modules.index"
+        kmod.write_index(kmod.build_index(self.moddir), path)
+        return kmod.read_index(path)
+
+
+    def test_module_name(self):
+        self.assertEqual(
+            kmod.module_name("kernel/sound/pci/hda/snd-hda-intel.ko.zst"),
+            "snd_hda_intel"
+        )
+        self.assertEqual(kmod.module_name("kernel/fs/ext4/ext4.ko"), "ext4")
+
+
+    def test_host_aliases(self):
+        self.assertEqual(
+            kmod.host_aliases(self.sysfs),
+            { alias for alias in host_devices.values() if alias }
+        )
+
+
+    def test_match_aliases(self):
+        index = self.index()
+
+        self.assertEqual(
+            kmod.match_aliases(index, kmod.host_aliases(self.sysfs)),
+            { "e1000e", "snd_hda_intel", "usb_storage" }
+        )
+        # the literal prefix of a pattern is shorter than the alias
+        self.assertEqual(
+            kmod.match_aliases(index, [ "fs-btrfs" ]), { "btrfs" }
+        )
+        # modules that are not in modules.dep are left out
+        alias = "pci:v0000BEEFd00000001sv00000000sd00000000bc00sc00i00"
+        self.assertEqual(kmod.match_aliases(index, [ alias ]), set())
+        self.assertEqual(kmod.match_aliases(index, [ "acpi:NOPE:" ]), set())
+
+
+    def test_resolve_deps(self):
+        index = self.index()
+
+        self.assertEqual(
+            kmod.resolve(index, { "usb-storage" }),
+            [
+                "kernel/drivers/scsi/scsi_mod.ko.zst",
+                "kernel/drivers/usb/usb-storage.ko.zst",
+            ]
+        )
+        # every module once, after what it depends on
+        self.assertEqual(
+            kmod.resolve(index, { "e1000e", "ptp_core" }),
+            [
+                "kernel/net/core/ptp-core.ko.zst",
+                "kernel/drivers/net/e1000e.ko.zst",
+            ]
+        )
+
+
+    def test_resolve_softdeps(self):
+        index = self.index()
+
+        # pre softdeps come before the module and its dependencies;
+        # missing ones (not-there, uas) are skipped
+        self.assertEqual(
+            kmod.resolve(index, { "btrfs" }),
+            [
+                "kernel/crypto/crc32c-generic.ko.zst",
+                "kernel/lib/raid6/raid6_pq.ko.zst",
+                "kernel/fs/btrfs/btrfs.ko.zst",
+            ]
+        )
+
+
+    def test_resolve_builtin(self):
+        index = self.index()
+
+        self.assertEqual(kmod.resolve(index, { "ext4", "ahci" }), [])
+
+        with self.assertRaises(ModuleError):
+            kmod.resolve(index, { "nonexistent" })
+
+
+    def test_index_key(self):
+        key = kmod.index_key(self.moddir)
+
+        (self.moddir / "modules.softdep").write_text(
+            modules_softdep + "softdep e1000e post: snd-hda-intel\n"
+        )
+        self.assertNotEqual(kmod.index_key(self.moddir), key)
+
+        # post softdeps come after the module
+        self.assertEqual(
+            kmod.resolve(self.index(), { "e1000e" }),
+            [
+                "kernel/net/core/ptp-core.ko.zst",
+                "kernel/drivers/net/e1000e.ko.zst",
+                "kernel/sound/pci/hda/snd-hda-intel.ko.zst",
+            ]
+        )
+
+
+    def test_missing_index(self):
+        (self.moddir / "modules.alias").unlink()
+
+        with self.assertRaises(ModuleError):
+            kmod.build_index(self.moddir)
+
+
+    def test_initrd_entries(self):
+        paths = kmod.resolve(self.index(), { "usb_storage" })
+        for path in paths:
+            (self.moddir / path).parent.mkdir(parents=True, exist_ok=True)
+            (self.moddir / path).write_bytes(b"module")
+
+        entries = kmod.initrd_entries(self.moddir, "6.1.0", paths)
+        names = [ entry[0] for entry in entries ]
+
+        self.assertIn("lib/modules/6.1.0/modules.dep", names)
+        self.assertIn(
+            "lib/modules/6.1.0/kernel/drivers/usb/usb-storage.ko.zst",
+            names
+        )
+        # directories come before what is in them
+        for i, name in enumerate(names):
+            parent = str(pathlib.PurePosixPath(name).parent)
+            if parent != ".":
+                self.assertIn(parent, names[:i])
+
+
+if __name__ == "__main__":
+    unittest.main()
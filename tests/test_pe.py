@@ -0,0 +1,172 @@
+import pathlib
+import struct
+import tempfile
+import unittest
+
+from ckis import pe
+from ckis.errors import ModuleError
+
+
+def make_stub(path, sections=[ (".text", b"\xc3" * 100) ], headers=0x400):
+    '''Write a minimal PE32+ image with sections to path, like an EFI stub
+    with headers bytes of headers.
+    '''
+    file_alignment, section_alignment = 0x200, 0x1000
+    opt = 0x40 + 4 + 20
+    sectab = opt + 240
+
+    data = bytearray(headers)
+    data[:2] = b"MZ"
+    struct.pack_into("<I", data, 0x3c, 0x40)
+    data[0x40:0x44] = b"PE\0\0"
+    # machine, sections, ..., size of the optional header, characteristics
+    struct.pack_into(
+        "<HHIIIHH", data, 0x44, 0x8664, len(sections), 0, 0, 0, 240, 0x22
+    )
+    struct.pack_into("<H", data, opt, 0x20b)
+    struct.pack_into("<II", data, opt + 32, section_alignment, file_alignment)
+    struct.pack_into("<I", data, opt + 60, headers)
+    struct.pack_into("<I", data, opt + 108, 16)
+
+    raw, virt = headers, section_alignment
+    for i, (name, contents) in enumerate(sections):
+        rawsize = pe.align(len(contents), file_alignment)
+        pe.section_header.pack_into(
+            data, sectab + 40 * i, name.encode(), len(contents), virt,
+            rawsize, raw, 0, 0, 0, 0, 0x60000020
+        )
+        data += contents + bytes(rawsize - len(contents))
+        raw += rawsize
+        virt += pe.align(len(contents), section_alignment)
+
+    struct.pack_into("<I", data, opt + 56, virt)
+    pathlib.Path(path).write_bytes(data)
+
+
+def sign(path, signature):
+    '''Append signature to the image at path as its certificate table, like
+    a signing tool would.
+    '''
+    data = bytearray(pathlib.Path(path).read_bytes())
+    img = pe.PEImage(data)
+
+    offset = len(data)
+    data += signature
+    struct.pack_into(
+        "<II", data, img.datadirs + 8 * pe.security_dir, offset,
+        len(signature)
+    )
+    # signing also sets the checksum
+    struct.pack_into("<I", data, img.opt + 64, 0x1234)
+    pathlib.Path(path).write_bytes(data)
+
+
+class PETest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = pathlib.Path(tmpdir.name)
+
+        self.stub = self.root / "linuxx64.efi.stub"
+        make_stub(self.stub)
+
+
+    def section(self, data, img, name):
+        for s in img.sections:
+            if s[0].rstrip(b"\0").decode() == name:
+                return bytes(data[s[4]:s[4] + s[1]])
+
+
+    def test_add_sections(self):
+        kernel = self.root / "vmlinuz"
+        kernel.write_bytes(b"MZkernel" * 1000)
+        empty = self.root / "empty"
+        empty.write_bytes(b"")
+        outp = self.root / "uki.efi"
+
+        pe.add_sections(self.stub, [
+            (".osrel", b"ID=test\n"),
+            (".cmdline", b"quiet\0"),
+            (".initrd", empty),
+            (".linux", kernel),
+        ], outp)
+
+        data = outp.read_bytes()
+        img = pe.PEImage(data)
+
+        self.assertEqual(
+            img.section_names(),
+            [ ".text", ".osrel", ".cmdline", ".initrd", ".linux" ]
+        )
+        self.assertEqual(self.section(data, img, ".text"), b"\xc3" * 100)
+        self.assertEqual(self.section(data, img, ".osrel"), b"ID=test\n")
+        self.assertEqual(self.section(data, img, ".cmdline"), b"quiet\0")
+        self.assertEqual(self.section(data, img, ".initrd"), b"")
+        self.assertEqual(
+            self.section(data, img, ".linux"), kernel.read_bytes()
+        )
+
+        # sections don't overlap, in the file or in memory
+        sections = sorted(img.sections, key=lambda s: s[4])
+        for prev, cur in zip(sections, sections[1:]):
+            self.assertLessEqual(prev[4] + prev[3], cur[4])
+            self.assertLessEqual(prev[2] + prev[1], cur[2])
+            self.assertEqual(cur[4] % img.file_alignment, 0)
+            self.assertEqual(cur[2] % img.section_alignment, 0)
+
+        self.assertEqual(len(data), img.raw_end())
+        self.assertEqual(
+            img.image_size, pe.align(img.virtual_end(), img.section_alignment)
+        )
+
+
+    def test_signed_stub(self):
+        # the signature of the stub is not carried over
+        sign(self.stub, b"signature" * 10)
+        outp = self.root / "uki.efi"
+        pe.add_sections(self.stub, [ (".cmdline", b"\0") ], outp)
+
+        img = pe.PEImage(outp.read_bytes())
+        self.assertEqual(outp.stat().st_size, img.raw_end())
+        self.assertEqual(img.section_names(), [ ".text", ".cmdline" ])
+
+
+    def test_invalid(self):
+        outp = self.root / "uki.efi"
+
+        with self.assertRaises(ModuleError):
+            pe.add_sections(self.stub, [ (".text", b"") ], outp)
+        with self.assertRaises(ModuleError):
+            pe.add_sections(self.stub, [ (".toolongname", b"") ], outp)
+
+        # no room in the headers for 20 more section table entries
+        with self.assertRaises(ModuleError):
+            pe.add_sections(
+                self.stub, [ (f".s{i}", b"") for i in range(20) ], outp
+            )
+
+        with self.assertRaises(ModuleError):
+            pe.PEImage(b"\x7fELF" + bytes(100))
+        with self.assertRaises(ModuleError):
+            pe.PEImage(b"MZ")
+
+
+    def test_authenticode_digest(self):
+        digest = pe.authenticode_digest(self.stub)
+
+        # the checksum and signatures are left out
+        sign(self.stub, b"signature" * 10)
+        self.assertEqual(pe.authenticode_digest(self.stub), digest)
+
+        other = self.root / "other.efi"
+        make_stub(other, [ (".text", b"\x90" * 100) ])
+        self.assertNotEqual(pe.authenticode_digest(other), digest)
+
+        empty = self.root / "empty"
+        empty.write_bytes(b"")
+        with self.assertRaises(ModuleError):
+            pe.authenticode_digest(empty)
+
+
+if __name__ == "__main__":
+    unittest.main()
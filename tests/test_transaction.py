@@ -0,0 +1,127 @@
+import os
+import pathlib
+import tempfile
+import unittest
+import unittest.mock
+
+from ckis import modules
+from ckis.chain import Chain
+from ckis.config import sanitize_config
+from ckis.transaction import Transaction
+
+
+# the modules of the repository, for layout/plain
+repo_modules = pathlib.Path(__file__).parent.parent / "modules"
+
+kernel_module = """
+modname = "test/kernel"
+moddesc = "A kernel that is not one"
+outputs = { "kernel" }
+
+def fire(self):
+    kernel = self.Kernel("vmlinuz")
+    kernel.path.write_bytes(b"new kernel")
+    return kernel
+"""
+
+# reads the kernel, wherever an earlier link put it
+reader_module = """
+modname = "test/reader"
+moddesc = "Copies the kernel into a config"
+inputs = { "kernel" }
+outputs = { "config" }
+
+def fire(self):
+    config = self.Config("seen")
+    config.path.write_bytes(self.inputs["kernel"].path.read_bytes())
+    return config
+"""
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.root = pathlib.Path(tmpdir.name)
+
+        moddir = self.root / "modules"
+        (moddir / "test").mkdir(parents=True)
+        (moddir / "test" / "kernel.py").write_text(kernel_module)
+        (moddir / "test" / "reader.py").write_text(reader_module)
+
+        for patch in [
+            unittest.mock.patch.object(
+                modules, "moddirs", [ str(moddir), str(repo_modules) ]
+            ),
+            unittest.mock.patch.object(modules, "module_index", None),
+            unittest.mock.patch.dict(modules.module_cache, clear=True),
+            unittest.mock.patch.dict(modules.info_cache, clear=True),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.boot = self.root / "boot"
+        self.boot.mkdir()
+        (self.root / "esp").mkdir()
+
+        self.transaction = Transaction("fast")
+        self.addCleanup(self.transaction.close)
+
+
+    def run_chain(self, links):
+        config = sanitize_config({
+            "chains": [{
+                "name": "test",
+                "links": links,
+                "boot": str(self.boot),
+                "esp": str(self.root / "esp"),
+            }]
+        })["chains"][0]
+
+        chain = Chain(
+            "6.1.0", config, durability = "fast",
+            transaction = self.transaction,
+        )
+        # the working directory is removed at the end of the run
+        chain.run(cleanup = False)
+        self.addCleanup(chain.cleanup)
+
+        return chain
+
+
+    def test_install_then_read(self):
+        # what is installed now is about to be replaced
+        (self.boot / "vmlinuz-6.1.0").write_bytes(b"old kernel")
+
+        chain = self.run_chain(
+            [ "test/kernel", "layout/plain", "test/reader" ]
+        )
+
+        # the link after the install read the staged kernel
+        seen = chain.store.latest("config")
+        self.assertEqual(seen.path.read_bytes(), b"new kernel")
+        self.assertEqual(
+            (self.boot / "vmlinuz-6.1.0").read_bytes(), b"old kernel"
+        )
+
+        # the installed artifact still refers to its destination
+        kernel = chain.store.latest("kernel")
+        self.assertTrue(kernel.installed)
+        self.assertEqual(kernel.path, self.boot / "vmlinuz-6.1.0")
+
+        self.assertEqual(self.transaction.commit(), 1)
+        self.assertEqual(
+            (self.boot / "vmlinuz-6.1.0").read_bytes(), b"new kernel"
+        )
+
+
+    def test_discard(self):
+        self.run_chain([ "test/kernel", "layout/plain" ])
+        self.transaction.discard(("test", "6.1.0"))
+
+        self.assertEqual(self.transaction.commit(), 0)
+        self.assertEqual(os.listdir(self.boot), [])
+
+
+if __name__ == "__main__":
+    unittest.main()